@@ -0,0 +1,120 @@
+import numpy as np
+
+ADDRESS_SIZE = 20
+# Type of the address IDs handed out by an `AddressTable`.
+ID_DTYPE = np.int32
+# Addresses decoded to hex per block, when streaming them out.
+_HEX_BLOCK_SIZE = 4096
+
+# Parse a `0x` prefixed hex address into its 20 raw bytes.
+def to_address_bytes(address):
+    if len(address) != 2 + 2 * ADDRESS_SIZE or address[:2] not in ('0x', '0X'):
+        raise ValueError('invalid address: %r' % (address,))
+    try:
+        data = bytes.fromhex(address[2:])
+    except ValueError:
+        raise ValueError('invalid address: %r' % (address,)) from None
+    if len(data) != ADDRESS_SIZE:
+        raise ValueError('invalid address: %r' % (address,))
+    return data
+
+# Turn a buffer of packed 20 byte addresses into (lowercase) hex addresses.
+def iter_hex_addresses(data):
+    hex_data = data.hex()
+    width = 2 * ADDRESS_SIZE
+    for i in range(0, len(hex_data), width):
+        yield '0x' + hex_data[i:i + width]
+
+# Interns addresses, so each distinct address is stored only once, as 20 raw
+# bytes in one contiguous buffer, and is referred to everywhere else by its
+# integer ID (its row in the buffer). Addresses only need to be turned back
+# into hex (always lowercase) on the way out.
+# The bytes -> ID index is built on the first lookup, so a table loaded from
+# a (memory-mapped) buffer costs nothing until something is interned in it.
+class AddressTable:
+    def __init__(self, buffer=None, capacity=1024):
+        if buffer is None:
+            self._buffer = np.zeros((capacity, ADDRESS_SIZE), dtype=np.uint8)
+            self._size = 0
+            self._index = {}
+        else:
+            self._buffer = buffer
+            self._size = len(buffer)
+            self._index = None
+
+    def __len__(self):
+        return self._size
+
+    # The (size, 20) array of raw addresses, indexed by ID.
+    @property
+    def buffer(self):
+        return self._buffer[:self._size]
+
+    def _get_index(self):
+        if self._index is None:
+            data = self.buffer.tobytes()
+            self._index = {
+                data[i:i + ADDRESS_SIZE]: j
+                for (j, i) in enumerate(range(0, len(data), ADDRESS_SIZE))
+            }
+        return self._index
+
+    def _grow(self):
+        buffer = np.zeros((max(1024, 2 * len(self._buffer)), ADDRESS_SIZE), dtype=np.uint8)
+        buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = buffer
+
+    # Free the spare capacity and the lookup index (which is rebuilt if it's
+    # needed again), once no more addresses are expected.
+    def trim(self):
+        if len(self._buffer) > self._size:
+            self._buffer = self.buffer.copy()
+        if self._size:
+            self._index = None
+
+    # Get the ID of 20 raw address bytes, adding them if they're new.
+    def intern_bytes(self, data):
+        index = self._get_index()
+        i = index.get(data)
+        if i is None:
+            i = self._size
+            if i == len(self._buffer):
+                self._grow()
+            self._buffer[i] = memoryview(data)
+            index[data] = i
+            self._size += 1
+        return i
+
+    # Get the ID of a hex address, adding it if it's new.
+    def intern(self, address):
+        return self.intern_bytes(to_address_bytes(address))
+
+    # Get the IDs of a (rows, 20) array of raw addresses, adding new ones.
+    def intern_all(self, rows):
+        data = np.ascontiguousarray(rows, dtype=np.uint8).tobytes()
+        return np.fromiter(
+            (self.intern_bytes(data[i:i + ADDRESS_SIZE]) for i in range(0, len(data), ADDRESS_SIZE)),
+            dtype=ID_DTYPE,
+            count=len(data) // ADDRESS_SIZE,
+        )
+
+    # Get the ID of a hex address, or `None` if it's not in the table.
+    def get_id(self, address):
+        return self._get_index().get(to_address_bytes(address))
+
+    def get_bytes(self, i):
+        return self._buffer[i].tobytes()
+
+    # The raw addresses of an array of IDs, as a (rows, 20) array.
+    def get_rows(self, ids):
+        return self.buffer[ids]
+
+    def to_hex(self, i):
+        return '0x' + self._buffer[i].tobytes().hex()
+
+    def to_hex_list(self, ids):
+        ids = np.asarray(ids)
+        hex_addresses = []
+        for i in range(0, len(ids), _HEX_BLOCK_SIZE):
+            hex_addresses.extend(iter_hex_addresses(self.buffer[ids[i:i + _HEX_BLOCK_SIZE]].tobytes()))
+        return hex_addresses
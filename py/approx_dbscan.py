@@ -0,0 +1,62 @@
+from data_utils import unique_rows
+import numpy as np
+import sklearn.cluster
+
+# Approximate DBSCAN on a grid coreset.
+#
+# Rows are snapped to a grid whose cells have a diameter of `rho * eps`, and
+# each non-empty cell is replaced by its center, weighted by the total
+# weight of its rows. Exact (weighted) DBSCAN then runs on the cell centers,
+# and the centers of its core cells are kept as the model's cores. Rows are
+# labeled like any other data the model predicts: with the label of the
+# nearest core center within `eps` (see `ClusteringModel.dbscan_predict()`),
+# so a saved model gives its training rows the labels it was fit with. If
+# there would be more than `max_cells` cells, the grid is coarsened (doubling
+# `rho`) until there aren't, so the DBSCAN step costs the same no matter how
+# many rows there are, and the whole fit is linear in the number of rows.
+#
+# Every row is at most `rho * eps / 2` from its cell's center, so distances
+# between cell centers are off by at most `rho * eps`. So, with the same
+# `min_samples`:
+#   - every core (or inlier) of exact DBSCAN with `eps * (1 - rho)` is within
+#     `eps` of a core center here, and
+#   - every row within `eps` of a core center here is a core (or inlier) of
+#     exact DBSCAN with `eps * (1 + rho)`.
+# That is, the rows marked as outliers are a superset of the outliers of
+# exact DBSCAN with `eps * (1 + rho)`, and a subset of the outliers with
+# `eps * (1 - rho)`. Only rows whose density is within that band of
+# `min_samples` can disagree with exact DBSCAN at `eps`. A grid with
+# `rho >= 1` would have cells wider than `eps`, whose rows can be out of
+# reach of their own (core) cell's center, so the grid is never coarsened
+# that far. If it would have to be, `max_cells` must be raised instead.
+
+DEFAULT_RHO = 0.1
+DEFAULT_MAX_CELLS = 20000
+
+# Fit approximate DBSCAN, returning the core cell centers, their labels, and
+# the `rho` actually used.
+def fit_grid_dbscan(features, weights, eps, min_samples, rho=DEFAULT_RHO, max_cells=DEFAULT_MAX_CELLS):
+    if not 0 < rho < 1:
+        raise ValueError('grid DBSCAN rho must be between 0 and 1 (got %g)' % rho)
+    features = np.asarray(features, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+    side = rho * eps / np.sqrt(features.shape[1])
+    keys, inverse = unique_rows(np.floor(features / side).astype(np.int64))
+    while len(keys) > max_cells:
+        if rho * 2 >= 1:
+            raise ValueError(
+                '%d grid DBSCAN cells at rho = %g, which can\'t be coarsened any further; '
+                'raise max_cells (--max-cells) to at least that' % (len(keys), rho)
+            )
+        # A grid with twice the side is made of whole cells of this one, so
+        # only the cells need to be regrouped, not the rows.
+        keys, cell_inverse = unique_rows(keys // 2)
+        inverse = cell_inverse[inverse]
+        side *= 2
+        rho *= 2
+    centers = (keys + 0.5) * side
+    cell_weights = np.bincount(inverse, weights=weights, minlength=len(keys))
+    dbscan_model = sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples)
+    cell_labels = dbscan_model.fit_predict(centers, sample_weight=cell_weights)
+    core_idx = dbscan_model.core_sample_indices_
+    return centers[core_idx], cell_labels[core_idx], rho
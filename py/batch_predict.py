@@ -0,0 +1,95 @@
+from clustering_model import ClusteringModel
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from data_utils import get_model_features, iter_cluster_data
+import metrics
+import numpy as np
+from report import ClusterReport
+
+# The model used by the batch prediction workers. Each worker loads it from
+# the model file, whose arrays are memory-mapped, so every worker shares the
+# same (read-only) pages.
+_worker_model = None
+
+def _init_predict_worker(model_file):
+    global _worker_model
+    _worker_model = ClusteringModel.load_from_file(model_file)
+    _worker_model._get_dbscan_index()
+
+def _predict_chunk(features, weights, dedup, dedup_decimals):
+    return np.asarray(
+        _worker_model.predict(features, weights=weights, dedup=dedup, dedup_decimals=dedup_decimals),
+        dtype=np.int32,
+    )
+
+# Label a stream of `CallData` chunks across `workers` processes, yielding
+# each chunk with its labels, in order. Only a few chunks per worker are in
+# flight at once, so memory doesn't grow with the input.
+def predict_chunks(
+        model_file,
+        chunks,
+        workers,
+        max_pending_per_worker=2,
+        dedup=False,
+        dedup_decimals=None,
+        float32=False,
+    ):
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_predict_worker,
+            initargs=(model_file,),
+        ) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append((
+                chunk,
+                executor.submit(
+                    _predict_chunk,
+                    get_model_features(chunk, float32),
+                    np.ascontiguousarray(chunk.weights),
+                    dedup,
+                    dedup_decimals,
+                ),
+            ))
+            if len(pending) >= workers * max_pending_per_worker:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
+
+# Label a (possibly huge) call data file in chunks of `chunk_size` rows,
+# across `workers` processes, writing per-caller labels to `labels_file`
+# and the cluster report to `output_file` as it goes. Returns the number of
+# rows labeled.
+def predict_file(
+        model_file,
+        call_data_file,
+        chunk_size=100000,
+        workers=1,
+        output_file=None,
+        labels_file=None,
+        cache=True,
+        tmp_dir=None,
+        dedup=False,
+        dedup_decimals=None,
+        float32=False,
+    ):
+    with metrics.span('predict_batch'), ClusterReport(labels_file, tmp_dir=tmp_dir) as report:
+        chunks = iter_cluster_data(call_data_file, chunk_size=chunk_size, cache=cache)
+        for (chunk, labels) in predict_chunks(
+                model_file,
+                chunks,
+                workers,
+                dedup=dedup,
+                dedup_decimals=dedup_decimals,
+                float32=float32,
+            ):
+            with metrics.span('add_labels'):
+                report.add(chunk, labels)
+            metrics.count('predict_rows', len(labels))
+            metrics.count('predict_outliers', int(np.count_nonzero(labels == -1)))
+        if output_file:
+            with metrics.span('write_output'):
+                report.write(output_file)
+        return report.num_rows
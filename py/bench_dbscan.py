@@ -0,0 +1,103 @@
+import approx_dbscan
+import argparse
+from clustering_model import ClusteringModel, DBSCANCores
+from data_utils import load_cluster_data
+import numpy as np
+import os
+import sklearn.cluster
+from synth_data import write_callers
+import sys
+import tempfile
+import time
+
+# Outlier mask of exact (weighted) DBSCAN.
+def exact_outliers(features, weights, eps, min_samples):
+    labels = sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples).fit_predict(
+        features,
+        sample_weight=weights,
+    )
+    return labels == -1
+
+# Time grid DBSCAN (and, on small enough data, exact DBSCAN) on the first
+# `size` rows, and check the grid outliers against the exact ones.
+def bench_size(features, weights, size, args):
+    features = features[:size]
+    weights = weights[:size]
+    t = time.perf_counter()
+    components, core_labels, rho = approx_dbscan.fit_grid_dbscan(
+        features,
+        weights,
+        args.eps,
+        args.min_samples,
+        rho=args.rho,
+        max_cells=args.max_cells,
+    )
+    labels = ClusteringModel.dbscan_predict(DBSCANCores(components, core_labels, args.eps), features)
+    result = {
+        'size': size,
+        'seconds': time.perf_counter() - t,
+        'rho': rho,
+        'outliers': np.count_nonzero(labels == -1),
+    }
+    if size <= args.exact_size:
+        t = time.perf_counter()
+        is_outlier = exact_outliers(features, weights, args.eps, args.min_samples)
+        result['exact_seconds'] = time.perf_counter() - t
+        result['disagreement'] = np.count_nonzero(is_outlier != (labels == -1)) / size
+        # The approximate outliers should be sandwiched between the exact
+        # outliers with a bigger and a smaller eps.
+        is_outlier_hi = exact_outliers(features, weights, args.eps * (1 + rho), args.min_samples)
+        is_outlier_lo = exact_outliers(features, weights, args.eps * (1 - rho), args.min_samples)
+        result['in_bound'] = bool(
+            np.all(is_outlier_hi <= (labels == -1)) and np.all((labels == -1) <= is_outlier_lo)
+        )
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark approximate (grid) DBSCAN against exact DBSCAN')
+    parser.add_argument('-n', '--callers', dest='sizes', default='10000,30000,100000,300000,1000000', type=str, help='comma separated numbers of synthetic callers to fit')
+    parser.add_argument('--data', dest='data_file', default=None, type=str, help='fit prefixes of this call data file instead of synthetic data')
+    parser.add_argument('--data-dir', dest='data_dir', default=None, type=str, help='where to keep (and reuse) generated call data (default: a temporary directory)')
+    parser.add_argument('--exact-size', dest='exact_size', default=20000, type=int, help='largest size to also fit exact DBSCAN on (it\'s quadratic)')
+    parser.add_argument('-e', '--eps', dest='eps', default=0.15, type=float, help='DBSCAN eps')
+    parser.add_argument('-s', '--samples', dest='min_samples', default=100, type=int, help='DBSCAN min_samples')
+    parser.add_argument('--rho', dest='rho', default=approx_dbscan.DEFAULT_RHO, type=float, help='grid cell diameter, as a fraction of eps')
+    parser.add_argument('--max-cells', dest='max_cells', default=approx_dbscan.DEFAULT_MAX_CELLS, type=int, help='most grid cells, before the grid is coarsened')
+    parser.add_argument('--seed', dest='seed', default=1337, type=int, help='synthetic data seed')
+    args = parser.parse_args()
+
+    sizes = [ int(s) for s in args.sizes.split(',') ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_file = args.data_file
+        if not data_file:
+            data_dir = args.data_dir or tmp_dir
+            os.makedirs(data_dir, exist_ok=True)
+            data_file = os.path.join(data_dir, 'synth-%d-%d.json' % (max(sizes), args.seed))
+            if not os.path.exists(data_file):
+                t = time.perf_counter()
+                write_callers(data_file, max(sizes), args.seed)
+                print('Generated %d callers in %.1f s.' % (max(sizes), time.perf_counter() - t), file=sys.stderr)
+        call_data = load_cluster_data(data_file, cache=args.data_dir is not None or args.data_file is not None)
+
+    results = []
+    print('%10s %10s %8s %9s %10s %13s %9s' % ('callers', 'seconds', 'rho', 'outliers', 'exact s', 'disagreement', 'in bound'))
+    for size in sizes:
+        r = bench_size(call_data.features, call_data.weights, min(size, len(call_data)), args)
+        results.append(r)
+        print('%10d %10.3f %8.3g %9d %10s %13s %9s' % (
+            r['size'],
+            r['seconds'],
+            r['rho'],
+            r['outliers'],
+            '%.3f' % r['exact_seconds'] if 'exact_seconds' in r else '-',
+            '%.4f%%' % (r['disagreement'] * 100) if 'disagreement' in r else '-',
+            r.get('in_bound', '-'),
+        ))
+    if len(results) > 1:
+        # The slope of log(time) against log(size), i.e., time ~ size^slope.
+        slope = np.polyfit(
+            np.log([ r['size'] for r in results ]),
+            np.log([ r['seconds'] for r in results ]),
+            1,
+        )[0]
+        print('grid DBSCAN time grows as callers^%.2f' % slope)
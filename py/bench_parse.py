@@ -0,0 +1,51 @@
+import argparse
+import filecmp
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+JS_PARSER = [ 'node', '--max-old-space-size=8192', os.path.join(ROOT_DIR, 'src', 'parse-call-data.js') ]
+PY_PARSER = [ sys.executable, os.path.join(ROOT_DIR, 'py', 'parse_call_data.py') ]
+
+def count_lines(file):
+    with open(file, 'rb') as f:
+        return sum(buf.count(b'\n') for buf in iter(lambda: f.read(1 << 20), b''))
+
+def run_parser(command, raw_file, output_file):
+    t = time.perf_counter()
+    subprocess.run(
+        [ *command, raw_file, '--output', output_file ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - t
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the python call data parser against the JS one')
+    parser.add_argument('-j', '--workers', dest='workers', default=1, type=int, help='worker processes for the python parser')
+    parser.add_argument('--no-js', dest='run_js', default=True, action='store_false', help='only run the python parser')
+    parser.add_argument(dest='raw_call_data_file', type=str, help='the raw call data file')
+    args = parser.parse_args()
+
+    num_calls = count_lines(args.raw_call_data_file)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outputs = {}
+        parsers = { 'python': [ *PY_PARSER, '--workers', str(args.workers) ] }
+        if args.run_js:
+            parsers['js'] = JS_PARSER
+        for (name, command) in parsers.items():
+            output_file = os.path.join(tmp_dir, name + '.json')
+            try:
+                elapsed = run_parser(command, args.raw_call_data_file, output_file)
+            except (OSError, subprocess.CalledProcessError) as err:
+                print('%-6s failed: %s' % (name, err))
+                continue
+            outputs[name] = output_file
+            print('%-6s %8.2f s  %10.0f raw calls/s' % (name, elapsed, num_calls / elapsed))
+        if len(outputs) == 2:
+            same = filecmp.cmp(outputs['python'], outputs['js'], shallow=False)
+            print('outputs are %s' % ('identical' if same else 'DIFFERENT'))
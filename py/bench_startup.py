@@ -0,0 +1,36 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PY_DIR = os.path.dirname(os.path.abspath(__file__))
+# What `fit`/`predict` import in batch (`--no-plot`) mode, and what they
+# additionally import when plotting.
+BATCH_IMPORTS = 'import clustering_model, data_utils'
+PLOT_IMPORTS = 'import matplotlib; matplotlib.use("Agg"); import matplotlib.pyplot, visuals'
+
+def time_command(code, runs):
+    times = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        subprocess.run([ sys.executable, '-c', code ], cwd=PY_DIR, check=True)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark script startup time with and without the plotting stack')
+    parser.add_argument('-n', '--runs', dest='runs', default=10, type=int, help='number of runs to take the median of')
+    args = parser.parse_args()
+
+    baseline = time_command('pass', args.runs)
+    batch = time_command(BATCH_IMPORTS, args.runs)
+    plotting = time_command('%s; %s' % (BATCH_IMPORTS, PLOT_IMPORTS), args.runs)
+    print('interpreter:   %7.1f ms' % (baseline * 1e3))
+    print('batch imports: %7.1f ms' % (batch * 1e3))
+    print('with plotting: %7.1f ms' % (plotting * 1e3))
+    print('--no-plot saves %.1f ms (%.0f%%) of startup time.' % (
+        (plotting - batch) * 1e3,
+        100 * (plotting - batch) / plotting,
+    ))
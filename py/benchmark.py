@@ -0,0 +1,246 @@
+import argparse
+from clustering_model import ClusteringModel
+from data_utils import collapse_clusters, load_cluster_data
+from datetime import datetime, timezone
+import json
+import os
+import pickle
+import platform
+import subprocess
+from synth_data import write_callers
+import sys
+import tempfile
+import time
+
+# Relative slowdown (or memory growth) that `--compare` flags as a regression.
+REGRESSION_THRESHOLD = 0.1
+
+# Each stage sets up its inputs, then times the work being benchmarked,
+# returning (seconds, items processed). Stages run in a forked child each,
+# so every stage gets its own peak RSS.
+def bench_load(ctx):
+    t = time.perf_counter()
+    call_data = load_cluster_data(ctx['data_file'], cache=False)
+    return time.perf_counter() - t, len(call_data)
+
+def bench_load_cached(ctx):
+    # Make sure there's a cache to load from, without timing it.
+    load_cluster_data(ctx['data_file'], cache=True)
+    t = time.perf_counter()
+    call_data = load_cluster_data(ctx['data_file'], cache=True)
+    call_data.features.sum()
+    return time.perf_counter() - t, len(call_data)
+
+def bench_fit(ctx):
+    call_data = load_cluster_data(ctx['data_file'])[:ctx['fit_size']]
+    model = ClusteringModel()
+    t = time.perf_counter()
+    model.fit(
+        call_data.features,
+        weights=call_data.weights.reshape(-1, 1),
+        num_clusters=ctx['num_clusters'],
+        eps=ctx['eps'],
+        min_samples=ctx['min_samples'],
+    )
+    elapsed = time.perf_counter() - t
+    model.save_to_file(ctx['model_file'])
+    return elapsed, len(call_data)
+
+def bench_dbscan_predict(ctx):
+    call_data = load_cluster_data(ctx['data_file'])
+    model = ClusteringModel.load_from_file(ctx['model_file'])
+    t = time.perf_counter()
+    ClusteringModel.dbscan_predict(
+        model.dbscan_model,
+        call_data.features,
+        index=model._get_dbscan_index(),
+    )
+    return time.perf_counter() - t, len(call_data)
+
+def bench_predict(ctx):
+    call_data = load_cluster_data(ctx['data_file'])
+    model = ClusteringModel.load_from_file(ctx['model_file'])
+    t = time.perf_counter()
+    labels = model.predict(call_data.features, weights=call_data.weights.reshape(-1, 1))
+    elapsed = time.perf_counter() - t
+    with open(ctx['labels_file'], 'wb') as f:
+        pickle.dump(labels, f)
+    return elapsed, len(call_data)
+
+def bench_collapse_clusters(ctx):
+    call_data = load_cluster_data(ctx['data_file'])
+    with open(ctx['labels_file'], 'rb') as f:
+        labels = pickle.load(f)
+    t = time.perf_counter()
+    collapse_clusters(call_data, labels)
+    return time.perf_counter() - t, len(call_data)
+
+STAGES = {
+    'load': bench_load,
+    'load_cached': bench_load_cached,
+    'fit': bench_fit,
+    'dbscan_predict': bench_dbscan_predict,
+    'predict': bench_predict,
+    'collapse_clusters': bench_collapse_clusters,
+}
+# Stages that read what another stage writes (the model, or the labels).
+STAGE_DEPENDENCIES = {
+    'dbscan_predict': 'fit',
+    'predict': 'fit',
+    'collapse_clusters': 'predict',
+}
+
+# Run a stage in a forked child, returning its timings and peak RSS.
+def run_stage(stage, ctx):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = STAGES[stage](ctx)
+        except BaseException as err:
+            result = err
+        with os.fdopen(write_fd, 'wb') as f:
+            pickle.dump(result, f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        result = pickle.load(f)
+    _, _, rusage = os.wait4(pid, 0)
+    if isinstance(result, BaseException):
+        raise RuntimeError('stage %s failed' % stage) from result
+    seconds, items = result
+    return {
+        'seconds': seconds,
+        'items': items,
+        'items_per_second': items / seconds if seconds > 0 else None,
+        # `ru_maxrss` is in KB on linux.
+        'peak_rss_mb': rusage.ru_maxrss / 1024,
+    }
+
+def get_commit():
+    try:
+        return subprocess.run(
+            [ 'git', 'rev-parse', '--short', 'HEAD' ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results):
+    for (size, stages) in results['sizes'].items():
+        print('%s callers:' % size)
+        for (stage, r) in stages.items():
+            print('  %-18s %9.3f s  %12.0f /s  %9.1f MB' % (
+                stage,
+                r['seconds'],
+                r['items_per_second'] or 0,
+                r['peak_rss_mb'],
+            ))
+
+# Compare two results files, flagging stages that got slower (or bigger) by
+# more than the threshold. Returns the number of regressions.
+def compare_results(old, new, threshold=REGRESSION_THRESHOLD):
+    print('Comparing %s (%s) -> %s (%s):' % (
+        old.get('commit'), old.get('date'),
+        new.get('commit'), new.get('date'),
+    ))
+    if old.get('params') != new.get('params'):
+        print('  (run with different parameters: %s vs %s)' % (old.get('params'), new.get('params')))
+    regressions = 0
+    for (size, stages) in new['sizes'].items():
+        for (stage, r) in stages.items():
+            old_r = old['sizes'].get(size, {}).get(stage)
+            if old_r is None:
+                continue
+            time_ratio = r['seconds'] / old_r['seconds'] if old_r['seconds'] else 1
+            rss_ratio = r['peak_rss_mb'] / old_r['peak_rss_mb'] if old_r['peak_rss_mb'] else 1
+            flag = ''
+            if time_ratio > 1 + threshold or rss_ratio > 1 + threshold:
+                flag = '  <-- REGRESSION'
+                regressions += 1
+            print('  %8s %-18s time x%.2f  rss x%.2f%s' % (size, stage, time_ratio, rss_ratio, flag))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the clustering pipeline on synthetic (or real) call data')
+    parser.add_argument('-n', '--callers', dest='sizes', default='10000,100000', type=str, help='comma separated numbers of synthetic callers to benchmark with')
+    parser.add_argument('--data', dest='data_file', default=None, type=str, help='benchmark with this call data file instead of synthetic data')
+    parser.add_argument('--data-dir', dest='data_dir', default=None, type=str, help='where to keep (and reuse) generated call data (default: a temporary directory)')
+    parser.add_argument('--stages', dest='stages', default=','.join(STAGES), type=str, help='comma separated stages to run')
+    parser.add_argument('--fit-size', dest='fit_size', default=50000, type=int, help='maximum rows to fit on (DBSCAN is quadratic)')
+    parser.add_argument('-c', '--clusters', dest='num_clusters', default=11, type=int, help='number of clusters to fit')
+    parser.add_argument('-e', '--eps', dest='eps', default=0.15, type=float, help='DBSCAN eps')
+    parser.add_argument('-s', '--samples', dest='min_samples', default=100, type=int, help='DBSCAN min_samples')
+    parser.add_argument('--seed', dest='seed', default=1337, type=int, help='synthetic data seed')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='save results to this JSON file')
+    parser.add_argument('--compare', dest='compare_file', default=None, type=str, help='compare against results saved from a previous run')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage: %s' % stage)
+        dependency = STAGE_DEPENDENCIES.get(stage)
+        if dependency and dependency not in stages[:stages.index(stage)]:
+            parser.error('stage %s needs stage %s to run before it' % (stage, dependency))
+    results = {
+        'commit': get_commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': {
+            'fit_size': args.fit_size,
+            'num_clusters': args.num_clusters,
+            'eps': args.eps,
+            'min_samples': args.min_samples,
+            'seed': args.seed,
+        },
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        if args.data_file:
+            # Benchmark through a link in the temporary directory, so the
+            # call data cache isn't left next to the real file.
+            data_file = os.path.join(tmp_dir, os.path.basename(args.data_file))
+            os.symlink(os.path.abspath(args.data_file), data_file)
+            datasets = { os.path.basename(args.data_file): data_file }
+        else:
+            datasets = {}
+            for size in (int(s) for s in args.sizes.split(',')):
+                data_file = os.path.join(data_dir, 'synth-%d-%d.json' % (size, args.seed))
+                if not os.path.exists(data_file):
+                    t = time.perf_counter()
+                    write_callers(data_file, size, args.seed)
+                    print('Generated %d callers in %.1f s.' % (size, time.perf_counter() - t), file=sys.stderr)
+                datasets[str(size)] = data_file
+        for (name, data_file) in datasets.items():
+            ctx = {
+                'data_file': data_file,
+                'model_file': os.path.join(tmp_dir, 'model.bin'),
+                'labels_file': os.path.join(tmp_dir, 'labels.pickle'),
+                'fit_size': args.fit_size,
+                'num_clusters': args.num_clusters,
+                'eps': args.eps,
+                'min_samples': args.min_samples,
+            }
+            results['sizes'][name] = {}
+            for stage in stages:
+                print('Running %s on %s...' % (stage, name), file=sys.stderr)
+                results['sizes'][name][stage] = run_stage(stage, ctx)
+
+    print_results(results)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved results to %s.' % args.output_file)
+    if args.compare_file:
+        with open(args.compare_file) as f:
+            regressions = compare_results(json.load(f), results)
+        sys.exit(1 if regressions else 0)
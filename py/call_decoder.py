@@ -0,0 +1,249 @@
+import glob
+import json
+import os
+import re
+import sys
+
+ABI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'abis')
+
+_MASK_64 = (1 << 64) - 1
+_KECCAK_ROUND_CONSTANTS = (
+    0x0000000000000001, 0x0000000000008082, 0x800000000000808a, 0x8000000080008000,
+    0x000000000000808b, 0x0000000080000001, 0x8000000080008081, 0x8000000000008009,
+    0x000000000000008a, 0x0000000000000088, 0x0000000080008009, 0x000000008000000a,
+    0x000000008000808b, 0x800000000000008b, 0x8000000000008089, 0x8000000000008003,
+    0x8000000000008002, 0x8000000000000080, 0x000000000000800a, 0x800000008000000a,
+    0x8000000080008081, 0x8000000000008080, 0x0000000080000001, 0x8000000080008008,
+)
+# Lane rotation offsets, indexed by x + 5 * y.
+_KECCAK_ROTATIONS = (
+    0, 1, 62, 28, 27,
+    36, 44, 6, 55, 20,
+    3, 10, 43, 25, 39,
+    41, 45, 15, 21, 8,
+    18, 2, 61, 56, 14,
+)
+
+def _keccak_f(lanes):
+    for rc in _KECCAK_ROUND_CONSTANTS:
+        # Theta.
+        c = [ lanes[x] ^ lanes[x + 5] ^ lanes[x + 10] ^ lanes[x + 15] ^ lanes[x + 20] for x in range(5) ]
+        d = [ c[(x - 1) % 5] ^ (((c[(x + 1) % 5] << 1) | (c[(x + 1) % 5] >> 63)) & _MASK_64) for x in range(5) ]
+        lanes = [ lanes[i] ^ d[i % 5] for i in range(25) ]
+        # Rho and pi.
+        b = [ 0 ] * 25
+        for x in range(5):
+            for y in range(5):
+                lane = lanes[x + 5 * y]
+                r = _KECCAK_ROTATIONS[x + 5 * y]
+                b[y + 5 * ((2 * x + 3 * y) % 5)] = ((lane << r) | (lane >> (64 - r))) & _MASK_64
+        # Chi and iota.
+        lanes = [
+            b[i] ^ (~b[(i + 1) % 5 + i - i % 5] & b[(i + 2) % 5 + i - i % 5])
+            for i in range(25)
+        ]
+        lanes[0] ^= rc
+    return lanes
+
+# Ethereum's keccak256 (not NIST SHA3-256). Only used for function selectors
+# and address checksums, which are cached, so a pure python version will do,
+# but pycryptodome's is used if it's installed.
+def _keccak256(data):
+    rate = 136
+    padded = bytearray(data) + b'\x01' + b'\x00' * (rate - 1 - len(data) % rate)
+    padded[-1] |= 0x80
+    lanes = [ 0 ] * 25
+    for offset in range(0, len(padded), rate):
+        for i in range(rate // 8):
+            lanes[i] ^= int.from_bytes(padded[offset + 8 * i:offset + 8 * i + 8], 'little')
+        lanes = _keccak_f(lanes)
+    return b''.join(lane.to_bytes(8, 'little') for lane in lanes[:4])
+
+try:
+    from Crypto.Hash import keccak as _keccak
+    keccak256 = lambda data: _keccak.new(digest_bits=256, data=data).digest()
+except ImportError:
+    keccak256 = _keccak256
+
+_checksum_cache = {}
+
+# EIP-55 checksum an address (from its 20 raw bytes), like web3 does when
+# decoding addresses.
+def to_checksum_address(address_bytes):
+    address = _checksum_cache.get(address_bytes)
+    if address is None:
+        hex_address = address_bytes.hex()
+        hashed = keccak256(hex_address.encode('ascii')).hex()
+        address = '0x' + ''.join(
+            c.upper() if int(h, 16) >= 8 else c
+            for (c, h) in zip(hex_address, hashed)
+        )
+        _checksum_cache[address_bytes] = address
+    return address
+
+def _to_canonical_type(param):
+    type_ = param['type']
+    if type_.startswith('tuple'):
+        return '(%s)%s' % (
+            ','.join(_to_canonical_type(c) for c in param['components']),
+            type_[len('tuple'):],
+        )
+    return type_
+
+def get_function_selector(method):
+    signature = '%s(%s)' % (
+        method['name'],
+        ','.join(_to_canonical_type(p) for p in method['inputs']),
+    )
+    return '0x' + keccak256(signature.encode('ascii'))[:4].hex()
+
+# Load and merge ABI files, keeping the first method of each name (like
+# `loadMergedAbiFiles()` in `parse-call-data.js`).
+def load_merged_abi_files(files):
+    abi = []
+    names = set()
+    for file in files:
+        with open(file) as f:
+            file_abi = json.load(f)
+        if not isinstance(file_abi, list):
+            file_abi = file_abi['compilerOutput']['abi']
+        for item in file_abi:
+            if item.get('name') not in names:
+                names.add(item.get('name'))
+                abi.append(item)
+    return abi
+
+def load_default_abi():
+    return load_merged_abi_files(sorted(glob.glob(os.path.join(ABI_DIR, '*.json'))))
+
+class CallDecodeError(Exception):
+    pass
+
+# Whether a method fills orders (as opposed to cancelling them, etc.).
+def is_fill_method(name):
+    return re.search(r'fill|buy|sell|match', name, re.IGNORECASE) is not None
+
+# What we need to know to pull the orders out of a method's call data.
+class _MethodInfo:
+    ORDER_PARAMS = ('order', 'leftOrder', 'rightOrder')
+
+    def __init__(self, method):
+        self.name = method['name']
+        self.is_fill = is_fill_method(self.name)
+        # Every input of these ABIs takes up one head slot (static tuples
+        # don't occur).
+        slots = { p['name']: i for (i, p) in enumerate(method['inputs']) }
+        types = { p['name']: p for p in method['inputs'] }
+        self.orders_slot = slots['orders'] if 'orders' in slots else None
+        self.order_slots = [ slots[n] for n in _MethodInfo.ORDER_PARAMS if n in slots ]
+        self.data_slot = slots['data'] if self.name == 'executeTransaction' else None
+        order_param = next(
+            (types[n] for n in ('orders', *_MethodInfo.ORDER_PARAMS) if n in types),
+            None,
+        )
+        if order_param is not None:
+            fields = [ c['name'] for c in order_param['components'] ]
+            self.maker_field = fields.index('makerAddress')
+            self.fee_recipient_field = fields.index('feeRecipientAddress')
+
+# A call extracted from call data: the method name (prefixed with `tx_`
+# inside `executeTransaction()`), the (maker, fee recipient) of each order,
+# and the fill and order update counts.
+class DecodedCall:
+    __slots__ = ('id', 'orders', 'fills', 'updates')
+
+    def __init__(self, id, orders, fills, updates):
+        self.id = id
+        self.orders = orders
+        self.fills = fills
+        self.updates = updates
+
+# Decodes Exchange and Forwarder call data, through a precomputed selector
+# table. Only the parts of the ABI-encoded arguments needed for aggregation
+# (order makers and fee recipients, and `executeTransaction()` data) are read.
+class CallDecoder:
+    def __init__(self, abi):
+        self._selectors_to_methods = {
+            get_function_selector(method): _MethodInfo(method)
+            for method in abi
+            if method['type'] == 'function'
+        }
+
+    # Like `CallDecoder.extractCalls()` in `parse-call-data.js`.
+    def extract_calls(self, call_data, call_type):
+        selector = call_data[:10].lower()
+        if selector not in self._selectors_to_methods:
+            raise CallDecodeError('Unknown selector: %s.' % selector)
+        return self._extract_calls(
+            self._selectors_to_methods[selector],
+            bytes.fromhex(call_data[10:]),
+            call_type,
+        )
+
+    def _extract_calls(self, method, args, call_type, prefix=''):
+        orders = []
+        data = None
+        try:
+            if method.orders_slot is not None:
+                orders = self._decode_order_array(method, args, _read_word(args, 32 * method.orders_slot))
+            elif method.order_slots:
+                orders = [
+                    self._decode_order(method, args, _read_word(args, 32 * slot))
+                    for slot in method.order_slots
+                ]
+            if method.data_slot is not None:
+                data = _read_bytes(args, _read_word(args, 32 * method.data_slot))
+        except CallDecodeError as err:
+            print('%s: %s (%s)' % (method.name, err, args.hex()), file=sys.stderr)
+            orders = []
+            data = None
+        fills = 0
+        updates = 0
+        if call_type == 'call':
+            if method.is_fill:
+                fills = len(orders)
+            updates = len(orders)
+        calls = [ DecodedCall(prefix + method.name, orders, fills, updates) ]
+        if data is not None:
+            selector = '0x' + data[:4].hex()
+            if selector not in self._selectors_to_methods:
+                raise CallDecodeError('Unknown selector: %s.' % selector)
+            calls.extend(self._extract_calls(
+                self._selectors_to_methods[selector],
+                data[4:],
+                call_type,
+                prefix='tx_' + prefix,
+            ))
+        return calls
+
+    def _decode_order_array(self, method, args, offset):
+        count = _read_word(args, offset)
+        start = offset + 32
+        if start + 32 * count > len(args):
+            raise CallDecodeError('order array out of bounds')
+        return [
+            self._decode_order(method, args, start + _read_word(args, start + 32 * i))
+            for i in range(count)
+        ]
+
+    def _decode_order(self, method, args, offset):
+        return (
+            _read_address(args, offset + 32 * method.maker_field),
+            _read_address(args, offset + 32 * method.fee_recipient_field),
+        )
+
+def _read_word(args, offset):
+    if offset + 32 > len(args):
+        raise CallDecodeError('read out of bounds')
+    return int.from_bytes(args[offset:offset + 32], 'big')
+
+def _read_address(args, offset):
+    if offset + 32 > len(args):
+        raise CallDecodeError('read out of bounds')
+    return to_checksum_address(bytes(args[offset + 12:offset + 32]))
+
+def _read_bytes(args, offset):
+    size = _read_word(args, offset)
+    if offset + 32 + size > len(args):
+        raise CallDecodeError('bytes out of bounds')
+    return args[offset + 32:offset + 32 + size]
@@ -1,90 +1,510 @@
+import approx_dbscan
+from data_utils import FEATURES, dedup_rows
+import metrics
+from model_format import is_model_file, read_model_file, write_model_file
 import numpy as np
+import scipy.optimize
+import scipy.spatial
 import sklearn.cluster
-import pickle
+import sklearn.neighbors
+
+# The parts of a fitted DBSCAN model that prediction needs.
+# `rho` is set for cores fit by grid DBSCAN (see `approx_dbscan.py`).
+class DBSCANCores:
+    def __init__(self, components, core_labels, eps, min_samples=None, rho=None):
+        self.components_ = components
+        self.core_labels_ = core_labels
+        self.eps = eps
+        self.min_samples = min_samples
+        self.rho = rho
+
+# The parts of a fitted KMeans model that prediction needs.
+class KMeansCenters:
+    def __init__(self, cluster_centers):
+        self.cluster_centers_ = cluster_centers
+        self.n_clusters = len(cluster_centers)
+
+    # Label each sample with its nearest cluster center.
+    def predict(self, features, sample_weight=None, chunk_size=8192):
+        features = np.asarray(features)
+        labels = np.empty(len(features), dtype=np.int32)
+        for i in range(0, len(features), chunk_size):
+            chunk = features[i:i + chunk_size]
+            dist = ((chunk[:, np.newaxis, :] - self.cluster_centers_) ** 2).sum(axis=2)
+            labels[i:i + chunk_size] = np.argmin(dist, axis=1)
+        return labels
 
 class ClusteringModel:
     def __init__(self, dbscan_model=None, kmeans_model=None):
         self.dbscan_model = dbscan_model
         self.kmeans_model = kmeans_model
 
-    def predict(self, features, weights=None):
-        weights = np.array(weights if weights is not None else [ 1 ] * len(features))
-        # Use DBSCAN to find outliers.
-        dbscan_labels = ClusteringModel.dbscan_predict(
-            self.dbscan_model,
-            np.array(features),
+    # If `dedup` is set, identical rows (or rows that are identical once
+    # rounded to `dedup_decimals` places) are only labeled once, and the
+    # labels are scattered back to every row.
+    def predict(self, features, weights=None, dedup=False, dedup_decimals=None):
+        if dedup:
+            with metrics.span('dedup'):
+                features, weights, inverse = dedup_rows(
+                    features,
+                    weights if weights is not None else np.ones(len(features)),
+                    dedup_decimals,
+                )
+            labels = self._predict(features, weights)[inverse]
+        else:
+            labels = self._predict(features, weights)
+        # Counted here, so deduplicated predictions count every caller, not
+        # just the unique rows.
+        metrics.count('predict_rows', len(labels))
+        metrics.count('predict_outliers', int(np.count_nonzero(labels == -1)))
+        return labels
+
+    def _predict(self, features, weights):
+        with metrics.span('predict'):
+            features = np.asarray(features)
+            weights = _to_weights(weights, len(features))
+            # Use DBSCAN to find outliers.
+            with metrics.span('dbscan'):
+                dbscan_labels = ClusteringModel.dbscan_predict(
+                    self.dbscan_model,
+                    features,
+                    index=self._get_dbscan_index(),
+                )
+            # Use KMeans on non-outliers. Weights don't change which center is
+            # nearest, so they aren't passed on (newer sklearn models don't
+            # take them).
+            with metrics.span('kmeans'):
+                non_outlier_features, _ = \
+                    ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
+                if not isinstance(self.kmeans_model, KMeansCenters):
+                    # sklearn's KMeans only predicts samples of its own dtype.
+                    non_outlier_features = non_outlier_features.astype(
+                        self.kmeans_model.cluster_centers_.dtype,
+                        copy=False,
+                    )
+                if len(non_outlier_features) > 0:
+                    kmeans_labels = self.kmeans_model.predict(non_outlier_features)
+                else:
+                    # sklearn's KMeans won't predict zero samples.
+                    kmeans_labels = np.zeros(0, dtype=np.int32)
+            return ClusteringModel._merge_labels(dbscan_labels, kmeans_labels)
+
+    # See `predict()` for `dedup` and `dedup_decimals`. Identical rows have
+    # the same neighbors and the same nearest center, so fitting only the
+    # unique rows, with summed weights, finds the same DBSCAN cores and
+    # minimizes the same KMeans inertia (though KMeans' random inits differ).
+    def fit(
+            self,
+            features,
+            weights=None,
+            num_clusters=16,
+            eps=0.05,
+            min_samples=100,
+            n_init=100,
+            dbscan_engine='exact',
+            dedup=False,
+            dedup_decimals=None,
+            **engine_args,
+        ):
+        if dedup:
+            with metrics.span('dedup'):
+                features, weights, inverse = dedup_rows(
+                    features,
+                    weights if weights is not None else np.ones(len(features)),
+                    dedup_decimals,
+                )
+            return self.fit(
+                features,
+                weights,
+                num_clusters=num_clusters,
+                eps=eps,
+                min_samples=min_samples,
+                n_init=n_init,
+                dbscan_engine=dbscan_engine,
+                **engine_args,
+            )[inverse]
+        with metrics.span('fit'):
+            features = np.asarray(features)
+            weights = _to_weights(weights, len(features))
+            # Use DBSCAN to fit outliers.
+            with metrics.span('dbscan'):
+                dbscan_labels = self.fit_outliers(
+                    features,
+                    weights,
+                    eps=eps,
+                    min_samples=min_samples,
+                    engine=dbscan_engine,
+                    **engine_args,
+                )
+            # Use KMeans to fit non-outliers.
+            with metrics.span('kmeans'):
+                # Filter out outliers.
+                non_outlier_features, non_outlier_weights = \
+                    ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
+                self.kmeans_model = ClusteringModel.fit_kmeans(
+                    non_outlier_features,
+                    non_outlier_weights,
+                    num_clusters - 1,
+                    n_init=n_init,
+                )
+            kmeans_labels = self.kmeans_model.labels_
+            metrics.count('fit_rows', len(features))
+            metrics.count('fit_outliers', len(features) - len(non_outlier_features))
+            return ClusteringModel._merge_labels(dbscan_labels, kmeans_labels)
+
+    # Fit the model out-of-core.
+    # The DBSCAN step is fit on a uniform sample of the data, which is
+    # `sample_fraction` of all rows, with its weights scaled up to match the
+    # density of the full data. The KMeans step is then fit with mini-batches
+    # of the non-outliers in `get_chunks()`, which should return an iterable
+    # of (features, weights) pairs over all the data.
+    def fit_streaming(
+            self,
+            sample_features,
+            sample_weights,
+            sample_fraction,
+            get_chunks,
+            num_clusters=16,
+            eps=0.05,
+            min_samples=100,
+            batch_size=10000,
+            epochs=1,
+            dbscan_engine='exact',
+            **engine_args,
+        ):
+        with metrics.span('fit_streaming'):
+            with metrics.span('dbscan'):
+                self.fit_outliers(
+                    sample_features,
+                    np.asarray(sample_weights).reshape(-1) / sample_fraction,
+                    eps=eps,
+                    min_samples=min_samples,
+                    engine=dbscan_engine,
+                    **engine_args,
+                )
+            with metrics.span('kmeans'):
+                self.kmeans_model = sklearn.cluster.MiniBatchKMeans(
+                    n_clusters=num_clusters - 1,
+                    batch_size=batch_size,
+                    random_state=1337,
+                )
+                for _ in range(epochs):
+                    # Inliers left over from the last chunk, short of a batch.
+                    rest_features, rest_weights = None, None
+                    for (features, weights) in get_chunks():
+                        dbscan_labels = ClusteringModel.dbscan_predict(
+                            self.dbscan_model,
+                            features,
+                            index=self._get_dbscan_index(),
+                        )
+                        is_inlier = dbscan_labels != -1
+                        batch_features = np.asarray(features)[is_inlier]
+                        batch_weights = np.asarray(weights).reshape(-1)[is_inlier]
+                        if rest_features is not None:
+                            batch_features = np.concatenate([ rest_features, batch_features ])
+                            batch_weights = np.concatenate([ rest_weights, batch_weights ])
+                        # One mini-batch step per `batch_size` inliers.
+                        num_full = len(batch_features) - len(batch_features) % batch_size
+                        for i in range(0, num_full, batch_size):
+                            self.kmeans_model.partial_fit(
+                                batch_features[i:i + batch_size],
+                                sample_weight=batch_weights[i:i + batch_size],
+                            )
+                        rest_features = batch_features[num_full:]
+                        rest_weights = batch_weights[num_full:]
+                    if rest_features is not None and len(rest_features) > 0:
+                        self.kmeans_model.partial_fit(
+                            rest_features,
+                            sample_weight=rest_weights,
+                        )
+
+    # Refit a fitted (or loaded) model on new data, warm-starting from it, and
+    # return the new labels. Old DBSCAN cores are kept if they're still dense
+    # in the new data, and only the points they don't cover are searched for
+    # new cores. KMeans then starts from the old cluster centers with a single
+    # init, and the new clusters are matched back to the old ones, so labels
+    # (and any heatmap ordering) stay the same across refits.
+    def refit(self, features, weights=None, eps=None, min_samples=None):
+        with metrics.span('refit'):
+            features = np.asarray(features)
+            weights = _to_weights(weights, len(features))
+            with metrics.span('dbscan'):
+                dbscan_labels = self.refit_outliers(
+                    features,
+                    weights,
+                    eps=eps if eps is not None else self.dbscan_model.eps,
+                    min_samples=min_samples if min_samples is not None else self.dbscan_model.min_samples,
+                )
+            with metrics.span('kmeans'):
+                non_outlier_features, non_outlier_weights = \
+                    ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
+                old_centers = np.asarray(self.kmeans_model.cluster_centers_)
+                kmeans_model = sklearn.cluster.KMeans(
+                    n_clusters=len(old_centers),
+                    init=old_centers,
+                    n_init=1,
+                    random_state=1337,
+                ).fit(
+                    non_outlier_features,
+                    sample_weight=non_outlier_weights,
+                )
+                centers, kmeans_labels = ClusteringModel._match_clusters(
+                    old_centers,
+                    kmeans_model.cluster_centers_,
+                    kmeans_model.labels_,
+                )
+                self.kmeans_model = KMeansCenters(centers)
+            metrics.count('fit_rows', len(features))
+            metrics.count('fit_outliers', len(features) - len(non_outlier_features))
+            return ClusteringModel._merge_labels(dbscan_labels, kmeans_labels)
+
+    # Refit only the DBSCAN (outlier) step, returning the DBSCAN labels.
+    # Points covered by a surviving old core are taken to be inliers without
+    # checking whether they're cores themselves. Every other point, and its
+    # neighbors, is checked exactly, like a full DBSCAN fit would.
+    # Duplicate rows (and duplicate cores) are only searched once, with their
+    # weights summed, which gives the same densities.
+    def refit_outliers(self, features, weights, eps, min_samples):
+        if min_samples is None:
+            raise ValueError('the model has no min_samples, pass one to refit')
+        features, weights, inverse = dedup_rows(features, weights)
+        old_cores, first = np.unique(
+            np.asarray(self.dbscan_model.components_).reshape(-1, features.shape[1]),
+            axis=0,
+            return_index=True,
+        )
+        old_core_labels = ClusteringModel.get_core_labels(self.dbscan_model)[first]
+        neighbors = sklearn.neighbors.NearestNeighbors(radius=eps).fit(features)
+        labels = np.full(len(features), -1, dtype=np.int64)
+        # Keep old cores that would still be cores if they were in the new data.
+        is_kept = _find_cores(neighbors, old_cores, old_core_labels, weights, eps, min_samples, labels)
+        # Only uncovered points and their neighbors can become new cores that
+        # matter (a new core near a covered point doesn't change anything).
+        uncovered = np.flatnonzero(labels == -1)
+        candidates = uncovered
+        if len(uncovered):
+            candidates = np.union1d(
+                uncovered,
+                neighbors.radius_neighbors_graph(features[uncovered], eps).indices,
+            ).astype(np.intp)
+        # New cores get a label of their own. DBSCAN labels only mark inliers.
+        new_core_labels = np.full(
+            len(candidates),
+            old_core_labels.max() + 1 if len(old_core_labels) else 0,
+            dtype=np.int64,
         )
-        # Use KMeans on non-outliers.
-        non_outlier_features, non_outlier_weights = \
-            ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
-        kmeans_labels = self.kmeans_model.predict(
-            non_outlier_features,
-            sample_weight=non_outlier_weights.reshape(-1),
+        is_new_core = _find_cores(
+            neighbors,
+            features[candidates],
+            new_core_labels,
+            weights,
+            eps,
+            min_samples,
+            labels,
         )
-        return ClusteringModel._merge_labels(dbscan_labels, kmeans_labels)
+        self.dbscan_model = DBSCANCores(
+            np.concatenate([ old_cores[is_kept], features[candidates[is_new_core]] ]),
+            np.concatenate([ old_core_labels[is_kept], new_core_labels[is_new_core] ]),
+            eps,
+            min_samples,
+        )
+        self._dbscan_index = None
+        return labels[inverse]
+
+    # Reorder refit cluster centers to line up with the old centers they're
+    # closest to (by minimum total distance), relabeling samples to match.
+    @staticmethod
+    def _match_clusters(old_centers, centers, labels):
+        cost = scipy.spatial.distance.cdist(old_centers, centers)
+        _, matched = scipy.optimize.linear_sum_assignment(cost)
+        relabeled = np.empty(len(matched), dtype=np.intp)
+        relabeled[matched] = np.arange(len(matched))
+        return centers[matched], relabeled[labels]
 
-    def fit(self, features, weights=None, num_clusters=16, eps=0.05, min_samples=100):
-        weights = np.array(weights if weights is not None else [ 1 ] * len(features))
-        # Use DBSCAN to fit outliers.
+    # Fit only the DBSCAN (outlier) step, returning the DBSCAN labels.
+    # `engine` is 'exact' (`sklearn.cluster.DBSCAN`) or 'grid', approximate
+    # DBSCAN on a grid coreset (see `approx_dbscan`), which takes `rho` and
+    # `max_cells`.
+    def fit_outliers(self, features, weights, eps=0.05, min_samples=100, engine='exact', **engine_args):
+        self._dbscan_index = None
+        if engine == 'grid':
+            components, core_labels, rho = approx_dbscan.fit_grid_dbscan(
+                features,
+                weights,
+                eps,
+                min_samples,
+                **engine_args,
+            )
+            self.dbscan_model = DBSCANCores(components, core_labels, eps, min_samples, rho=rho)
+            metrics.gauge('dbscan_grid_rho', rho)
+            return ClusteringModel.dbscan_predict(
+                self.dbscan_model,
+                features,
+                index=self._get_dbscan_index(),
+            )
+        if engine != 'exact':
+            raise ValueError('unknown DBSCAN engine: %s' % engine)
         self.dbscan_model = sklearn.cluster.DBSCAN(
             eps=eps,
             min_samples=min_samples,
         )
-        dbscan_labels = self.dbscan_model.fit_predict(
-            np.array(features),
-            sample_weight=weights,
+        return self.dbscan_model.fit_predict(
+            np.asarray(features),
+            sample_weight=np.asarray(weights).reshape(-1),
         )
-        # Use KMeans to fit non-outliers.
-        # Filter out outliers.
-        non_outlier_features, non_outlier_weights = \
-            ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
-        self.kmeans_model = sklearn.cluster.KMeans(
-            n_clusters=num_clusters - 1,
-            n_init=100,
+
+    # Fit the KMeans step on non-outliers.
+    @staticmethod
+    def fit_kmeans(features, weights, n_clusters, n_init=100):
+        return sklearn.cluster.KMeans(
+            n_clusters=n_clusters,
+            n_init=n_init,
             random_state=1337,
+        ).fit(
+            features,
+            sample_weight=np.asarray(weights).reshape(-1),
         )
-        kmeans_labels = self.kmeans_model.fit(
-            non_outlier_features,
-            sample_weight=non_outlier_weights.reshape(-1)
-        ).labels_
-        return ClusteringModel._merge_labels(dbscan_labels, kmeans_labels)
 
+    # The DBSCAN index is derived from the model, so it is rebuilt lazily
+    # after loading rather than pickled along with it.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_dbscan_index', None)
+        return state
+
+    def _get_dbscan_index(self):
+        if self.__dict__.get('_dbscan_index') is None:
+            self._dbscan_index = ClusteringModel.build_dbscan_index(self.dbscan_model)
+        return self._dbscan_index
+
+    # Save only what prediction needs, as flat arrays in a model file.
     def save_to_file(self, file):
-        with open(file, 'wb') as f:
-            f.write(pickle.dumps(self))
+        dbscan_model = self.dbscan_model
+        write_model_file(
+            file,
+            {
+                'features': FEATURES,
+                'eps': float(dbscan_model.eps),
+                'min_samples': _to_int(getattr(dbscan_model, 'min_samples', None)),
+                'viz_column_ordering': _to_int_list(getattr(self, 'viz_column_ordering', None)),
+                'viz_row_ordering': _to_int_list(getattr(self, 'viz_row_ordering', None)),
+            },
+            {
+                'core_components': dbscan_model.components_,
+                'core_labels': ClusteringModel.get_core_labels(dbscan_model),
+                'cluster_centers': self.kmeans_model.cluster_centers_,
+            },
+        )
 
+    # Load a model file. Older, pickled models have to be converted with
+    # `convert_model.py` first (they're never unpickled here).
     @staticmethod
     def load_from_file(file):
-        with open(file, 'rb') as f:
-            return pickle.loads(f.read())
+        if not is_model_file(file):
+            raise ValueError(
+                '%s is not a model file. If it\'s an older, pickled model, convert it with '
+                '`python py/convert_model.py %s NEW_MODEL_FILE`.' % (file, file)
+            )
+        params, arrays = read_model_file(file)
+        if params['features'] != FEATURES:
+            raise ValueError('model %s was trained on different features' % file)
+        model = ClusteringModel(
+            DBSCANCores(
+                arrays['core_components'],
+                arrays['core_labels'],
+                params['eps'],
+                params['min_samples'],
+            ),
+            KMeansCenters(arrays['cluster_centers']),
+        )
+        model.viz_column_ordering = params['viz_column_ordering']
+        model.viz_row_ordering = params['viz_row_ordering']
+        return model
 
+    # Get the cluster label of each core sample of a DBSCAN model.
     @staticmethod
-    def dbscan_predict(model, features):
-        features = np.array(features)
-        n_samples = len(features)
-        labels = [ -1 ] * len(features)
-        for i in range(n_samples):
-            diff = model.components_ - features[i, : ]
-            dist = np.linalg.norm(diff, axis=1)
-            nearest_idx = np.argmin(dist)
-            if dist[nearest_idx] < model.eps:
-                labels[i] = model.labels_[model.core_sample_indices_[nearest_idx]]
+    def get_core_labels(model):
+        if isinstance(model, DBSCANCores):
+            return model.core_labels_
+        return np.asarray(model.labels_)[model.core_sample_indices_]
+
+    # Build a KD-tree over the DBSCAN core samples, along with the cluster
+    # label of each core sample.
+    @staticmethod
+    def build_dbscan_index(model):
+        core_labels = ClusteringModel.get_core_labels(model)
+        if len(core_labels) == 0:
+            return None, core_labels
+        return scipy.spatial.cKDTree(model.components_), core_labels
+
+    # Assign each sample the label of its nearest core sample, if that core
+    # sample is closer than `eps`, otherwise -1 (outlier).
+    # Samples are queried `chunk_size` at a time, so the temporaries (and
+    # the tree's float64 copy of float32 samples) stay small.
+    @staticmethod
+    def dbscan_predict(model, features, index=None, chunk_size=65536):
+        features = np.asarray(features)
+        tree, core_labels = index or ClusteringModel.build_dbscan_index(model)
+        labels = np.full(len(features), -1, dtype=core_labels.dtype)
+        if tree is None or len(features) == 0:
+            return labels
+        for i in range(0, len(features), chunk_size):
+            chunk = features[i:i + chunk_size]
+            # Query with a little slack, then recheck candidates with the exact
+            # distance so samples right on the `eps` boundary match a full scan.
+            dist, nearest_idx = tree.query(
+                chunk,
+                k=1,
+                distance_upper_bound=model.eps * (1 + 1e-6),
+            )
+            candidates = np.flatnonzero(np.isfinite(dist))
+            nearest_idx = nearest_idx[candidates]
+            dist = np.linalg.norm(
+                model.components_[nearest_idx] - chunk[candidates],
+                axis=1,
+            )
+            in_range = dist < model.eps
+            labels[i + candidates[in_range]] = core_labels[nearest_idx[in_range]]
         return labels
 
     @staticmethod
     def _get_non_outliers(features, weights, dbscan_labels):
-        non_outlier_features = np.array([ f for (i, f) in enumerate(features) if dbscan_labels[i] != -1 ])
-        non_outlier_weights = np.array([ w for (i, w) in enumerate(weights) if dbscan_labels[i] != -1 ])
-        return np.array(non_outlier_features), np.array(non_outlier_weights)
+        is_inlier = np.asarray(dbscan_labels) != -1
+        return np.asarray(features)[is_inlier], np.asarray(weights)[is_inlier]
 
+    # Scatter the KMeans labels of the non-outliers back into place, with
+    # outliers labeled -1.
     @staticmethod
     def _merge_labels(dbscan_labels, kmeans_labels):
-        merged_labels = []
-        i = 0
-        for label in dbscan_labels:
-            if label == -1:
-                merged_labels.append(-1)
-            else:
-                merged_labels.append(kmeans_labels[i])
-                i += 1
+        kmeans_labels = np.asarray(kmeans_labels)
+        merged_labels = np.full(len(dbscan_labels), -1, dtype=kmeans_labels.dtype)
+        merged_labels[np.asarray(dbscan_labels) != -1] = kmeans_labels
         return merged_labels
+
+# Find which of `points` would be DBSCAN cores in the data indexed by
+# `neighbors` (the total weight of their neighbors within `eps` reaches
+# `min_samples`), and set `labels` of the data points they cover to
+# `core_labels`. Uses the same neighbor search as `sklearn.cluster.DBSCAN`,
+# in chunks to bound memory.
+def _find_cores(neighbors, points, core_labels, weights, eps, min_samples, labels, chunk_size=4096):
+    is_core = np.zeros(len(points), dtype=bool)
+    for i in range(0, len(points), chunk_size):
+        graph = neighbors.radius_neighbors_graph(points[i:i + chunk_size], eps, mode='connectivity')
+        chunk_is_core = graph @ weights >= min_samples
+        is_core[i:i + chunk_size] = chunk_is_core
+        covered = graph[chunk_is_core].tocoo()
+        labels[covered.col] = core_labels[i:i + chunk_size][chunk_is_core][covered.row]
+    return is_core
+
+# Sample weights as a flat array (all ones if there are none), without
+# copying them.
+def _to_weights(weights, num_rows):
+    if weights is None:
+        return np.ones(num_rows)
+    return np.asarray(weights).reshape(-1)
+
+def _to_int(value):
+    return int(value) if value is not None else None
+
+def _to_int_list(values):
+    return [ int(v) for v in values ] if values is not None else None
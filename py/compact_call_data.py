@@ -0,0 +1,73 @@
+import argparse
+from data_utils import SCALAR_COLUMNS, load_cluster_data
+import json
+import numpy as np
+import os
+from parse_call_data import compact_records, write_records
+from sketches import DEFAULT_PRECISION
+import time
+import tracemalloc
+
+UNIQUE_COLUMNS = ('unique_senders', 'unique_fee_recipients', 'unique_makers')
+
+def read_records(file):
+    with open(file) as f:
+        for line in f:
+            yield json.loads(line)
+
+# Time and peak (python heap) memory of loading a call data file, and of
+# holding all its records in memory at once (like merging windows does).
+def profile_load(file):
+    tracemalloc.start()
+    t = time.perf_counter()
+    call_data = load_cluster_data(file, cache=False)
+    load_time = time.perf_counter() - t
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracemalloc.start()
+    records = list(read_records(file))
+    records_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return call_data, load_time, load_peak, records_size
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert parsed call data to compact records and report the savings')
+    parser.add_argument('--exact', dest='exact', default=False, action='store_true', help='store exact distinct counts (smallest, but not mergeable)')
+    parser.add_argument('--precision', dest='precision', default=DEFAULT_PRECISION, type=int, help='sketch precision (log2 of the number of registers)')
+    parser.add_argument(dest='input_file', type=str, help='parsed call data file')
+    parser.add_argument(dest='output_file', type=str, help='compact call data file')
+    args = parser.parse_args()
+
+    with open(args.output_file, 'w') as f:
+        write_records(
+            compact_records(read_records(args.input_file), 'exact' if args.exact else 'sketch', args.precision),
+            f,
+        )
+    print('Wrote compact call data to %s.' % args.output_file)
+
+    full, full_time, full_peak, full_records = profile_load(args.input_file)
+    compact, compact_time, compact_peak, compact_records_size = profile_load(args.output_file)
+    mb = lambda n: n / 2**20
+    print('file size:      %10.2f -> %10.2f MB' % (
+        mb(os.path.getsize(args.input_file)),
+        mb(os.path.getsize(args.output_file)),
+    ))
+    print('records size:   %10.2f -> %10.2f MB' % (mb(full_records), mb(compact_records_size)))
+    print('load peak:      %10.2f -> %10.2f MB' % (mb(full_peak), mb(compact_peak)))
+    print('load time:      %10.2f -> %10.2f s' % (full_time, compact_time))
+    for name in UNIQUE_COLUMNS:
+        expected = getattr(full, name).astype(np.float64)
+        error = np.abs(getattr(compact, name) - expected) / np.maximum(1, expected)
+        print('%-22s max error %.4f%%, mean error %.4f%%, %d/%d exact' % (
+            name,
+            error.max(initial=0) * 100,
+            error.mean() * 100 if len(error) else 0,
+            np.count_nonzero(error == 0),
+            len(error),
+        ))
+    same = all(
+        np.array_equal(getattr(full, name), getattr(compact, name))
+        for name in SCALAR_COLUMNS if name not in UNIQUE_COLUMNS
+    )
+    print('other columns are %s' % ('identical' if same else 'DIFFERENT'))
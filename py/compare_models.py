@@ -0,0 +1,129 @@
+import argparse
+from clustering_model import ClusteringModel
+from data_utils import dedup_rows, get_model_features, label_to_classs_name, load_cluster_data
+import json
+import metrics
+import numpy as np
+import os
+import scipy.optimize
+import sklearn.metrics
+import time
+
+# Get a unique (short) name for each model file.
+def get_model_names(model_files):
+    names = [ os.path.splitext(os.path.basename(f))[0] for f in model_files ]
+    if len(frozenset(names)) < len(names):
+        return list(model_files)
+    return names
+
+# Label the same features under every model, returning a (rows, models)
+# label matrix and the seconds each model took.
+def label_all(models, features, weights):
+    labels = np.empty((len(features), len(models)), dtype=np.int32)
+    seconds = []
+    for (i, model) in enumerate(models):
+        t = time.perf_counter()
+        with metrics.span('model_%d' % i):
+            labels[:, i] = model.predict(features, weights)
+        seconds.append(time.perf_counter() - t)
+    return labels, seconds
+
+# Compare two labelings of the same callers: the contingency table (rows are
+# `labels_a`, columns `labels_b`, in label order), the adjusted Rand index,
+# and the fraction of callers that land in matching clusters, once clusters
+# are matched up to maximize that.
+def compare_labels(labels_a, labels_b):
+    unique_a, inverse_a = np.unique(labels_a, return_inverse=True)
+    unique_b, inverse_b = np.unique(labels_b, return_inverse=True)
+    table = np.zeros((len(unique_a), len(unique_b)), dtype=np.int64)
+    np.add.at(table, (inverse_a, inverse_b), 1)
+    rows, cols = scipy.optimize.linear_sum_assignment(-table)
+    return {
+        'labels_a': unique_a.tolist(),
+        'labels_b': unique_b.tolist(),
+        'contingency': table.tolist(),
+        'adjusted_rand_index': float(sklearn.metrics.adjusted_rand_score(labels_a, labels_b)),
+        'agreement': float(table[rows, cols].sum() / max(1, len(labels_a))),
+        'outlier_agreement': float(np.mean((labels_a == -1) == (labels_b == -1))) if len(labels_a) else 1.,
+    }
+
+def print_comparison(name_a, name_b, comparison):
+    print('%s vs %s: ARI %.4f, agreement %.2f%%, outlier agreement %.2f%%' % (
+        name_a,
+        name_b,
+        comparison['adjusted_rand_index'],
+        comparison['agreement'] * 100,
+        comparison['outlier_agreement'] * 100,
+    ))
+    col_names = [ label_to_classs_name(l) for l in comparison['labels_b'] ]
+    width = max(10, *(len(n) for n in col_names))
+    print('  %-*s %s' % (width, '', ' '.join('%*s' % (width, n) for n in col_names)))
+    for (label, row) in zip(comparison['labels_a'], comparison['contingency']):
+        print('  %-*s %s' % (width, label_to_classs_name(label), ' '.join('%*d' % (width, c) for c in row)))
+
+def write_labels(file, callers, names, labels):
+    with open(file, 'w') as f:
+        f.write(','.join([ 'caller', *names ]) + '\n')
+        for (caller, row) in zip(callers, labels.tolist()):
+            f.write('%s,%s\n' % (caller, ','.join(str(l) for l in row)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Label call data under several cluster models at once, and compare them')
+    parser.add_argument('-m', '--model', dest='model_files', action='append', required=True, help='a cluster model file (pass two or more)')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='write the comparison (timings, contingency tables, ARIs) to this JSON file')
+    parser.add_argument('--labels', dest='labels_file', default=None, type=str, help='write each caller\'s label under every model to this CSV file')
+    parser.add_argument('--dedup', dest='dedup', default=False, action='store_true', help='label each distinct feature row only once')
+    parser.add_argument('--float32', dest='float32', default=False, action='store_true', help='predict on single precision features, to halve their memory')
+    parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false', help='do not read or write the parsed call data cache')
+    metrics.add_arguments(parser)
+    parser.add_argument(dest='call_data_file', type=str, help='the call data file, or a day snapshot window (DIR@SINCE..UNTIL)')
+    args = parser.parse_args()
+    if len(args.model_files) < 2:
+        parser.error('pass at least two models to compare')
+    metrics.enable_from_args(args)
+
+    names = get_model_names(args.model_files)
+    models = [ ClusteringModel.load_from_file(f) for f in args.model_files ]
+    call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
+    print(f'Loaded {len(call_data)} call data entries.')
+
+    # Every model labels the same features (deduplicated only once).
+    features = get_model_features(call_data, args.float32)
+    weights = call_data.weights
+    if args.dedup:
+        features, weights, inverse = dedup_rows(features, weights)
+    labels, seconds = label_all(models, features, weights)
+    if args.dedup:
+        labels = labels[inverse]
+
+    results = { 'models': {}, 'comparisons': [] }
+    print('%-24s %10s %10s %10s %10s' % ('model', 'seconds', 'clusters', 'outliers', 'eps'))
+    for (i, name) in enumerate(names):
+        model_labels = labels[:, i]
+        results['models'][name] = {
+            'file': args.model_files[i],
+            'seconds': seconds[i],
+            'eps': float(models[i].dbscan_model.eps),
+            'clusters': len(models[i].kmeans_model.cluster_centers_) + 1,
+            'outliers': int(np.count_nonzero(model_labels == -1)),
+            'counts': {
+                label_to_classs_name(l): int(c)
+                for (l, c) in zip(*np.unique(model_labels, return_counts=True))
+            },
+        }
+        r = results['models'][name]
+        print('%-24s %10.3f %10d %10d %10g' % (name, r['seconds'], r['clusters'], r['outliers'], r['eps']))
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            comparison = compare_labels(labels[:, i], labels[:, j])
+            print_comparison(names[i], names[j], comparison)
+            results['comparisons'].append({ 'model_a': names[i], 'model_b': names[j], **comparison })
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Wrote comparison to %s.' % args.output_file)
+    if args.labels_file:
+        write_labels(args.labels_file, call_data.callers, names, labels)
+        print('Wrote caller labels to %s.' % args.labels_file)
+    metrics.write_from_args(args)
@@ -0,0 +1,50 @@
+import argparse
+from clustering_model import ClusteringModel
+from model_format import is_model_file
+import os
+import pickle
+import time
+
+# Modules of the classes in older pickled models that sklearn has since
+# renamed.
+RENAMED_MODULES = {
+    'sklearn.cluster.dbscan_': 'sklearn.cluster._dbscan',
+    'sklearn.cluster.k_means_': 'sklearn.cluster._kmeans',
+}
+
+class _ModelUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        return super().find_class(RENAMED_MODULES.get(module, module), name)
+
+# Load an older, pickled model. This is the only place models are unpickled,
+# and since unpickling can run arbitrary code, only convert files you trust.
+def load_pickled_model(file):
+    with open(file, 'rb') as f:
+        return _ModelUnpickler(f).load()
+
+def time_load(load, file, repeat=5):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        load(file)
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert a pickled cluster model to the model file format')
+    parser.add_argument(dest='input_file', type=str, help='pickled cluster model file')
+    parser.add_argument(dest='output_file', type=str, help='converted cluster model file (may be the same as the input)')
+    args = parser.parse_args()
+
+    if is_model_file(args.input_file):
+        print('%s is already a model file.' % args.input_file)
+        exit(0)
+    old_size = os.path.getsize(args.input_file)
+    old_load_time = time_load(load_pickled_model, args.input_file)
+    load_pickled_model(args.input_file).save_to_file(args.output_file)
+    new_size = os.path.getsize(args.output_file)
+    new_load_time = time_load(ClusteringModel.load_from_file, args.output_file)
+    print('Converted %s to %s.' % (args.input_file, args.output_file))
+    print('size: %d -> %d bytes' % (old_size, new_size))
+    print('load time: %.2f -> %.2f ms' % (old_load_time * 1e3, new_load_time * 1e3))
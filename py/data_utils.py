@@ -1,8 +1,13 @@
+from addresses import AddressTable, ID_DTYPE
 from class_names import CLASS_NAMES
 import json
+import metrics
 import numpy as np
-import scipy
+import os
+import scipy.stats
 import re
+from sketches import get_unique_counts
+from snapshots import is_window_spec, iter_window_records
 
 FEATURES = [
     'calls_to_batchCancelOrders',
@@ -44,15 +49,37 @@ FEATURES = [
     'unique_senders'
 ]
 
+# Scalar (non-method) columns kept for every caller.
+SCALAR_COLUMNS = (
+    'unique_senders',
+    'unique_fee_recipients',
+    'unique_makers',
+    'total_calls',
+    'total_orders',
+    'total_fills',
+    'max_calls',
+)
+# Scalar columns that are softsign-squashed when used as features.
+SOFTSIGN_COLUMNS = frozenset((
+    'unique_senders',
+    'unique_fee_recipients',
+    'unique_makers',
+))
+# Feature column of each method, for methods that are features.
+METHOD_FEATURE_INDICES = {
+    f[len('calls_to_'):]: i for (i, f) in enumerate(FEATURES) if f.startswith('calls_to_')
+}
+# Bump whenever the feature transform (e.g., `softsign()`) or the cached
+# columns change, to invalidate cached call data.
+FEATURES_VERSION = 2
+
 def softsign(x):
     return x / (1 + abs(x))
 
 def parse_cluster_data_item(data):
     total_method_calls = sum(data['methods'].values())
     max_method_calls = max(data['methods'].values())
-    total_senders = len([ a for a in data['senders'] if a != data['caller'] ])
-    total_fee_recipients = len(data['feeRecipients'])
-    total_makers = len(data['makers'])
+    total_senders, total_fee_recipients, total_makers = get_unique_counts(data)
     return {
         'caller': data['caller'],
         'unique_senders': total_senders,
@@ -86,9 +113,351 @@ def to_features(data_item):
 def to_weight(data_item):
     return max(1, data_item['total_orders'], data_item['unique_senders'])
 
-def load_cluster_data(file):
+# Parsed call data for many callers, stored as typed columns.
+# Rows line up across `caller_ids`, `features`, `weights` and each of the
+# `SCALAR_COLUMNS`. Callers are IDs in the `addresses` table (see
+# `addresses.py`), which several `CallData`s may share.
+class CallData:
+    def __init__(self, addresses, caller_ids, features, columns, weights=None):
+        self.addresses = addresses
+        self.caller_ids = caller_ids
+        self.features = features
+        for name in SCALAR_COLUMNS:
+            setattr(self, name, columns[name])
+        if weights is None:
+            # Same as `to_weight()`.
+            weights = np.maximum(
+                1,
+                np.maximum(self.total_orders, self.unique_senders),
+            ).astype(np.float64)
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.caller_ids)
+
+    # The callers' (hex) addresses, for output.
+    @property
+    def callers(self):
+        return self.addresses.to_hex_list(self.caller_ids)
+
+    # Select a subset of rows (by mask, indices or slice).
+    def __getitem__(self, rows):
+        return CallData(
+            self.addresses,
+            self.caller_ids[rows],
+            self.features[rows],
+            { name: getattr(self, name)[rows] for name in SCALAR_COLUMNS },
+            self.weights[rows],
+        )
+
+    # The same rows, with their callers interned in `addresses` instead.
+    def with_addresses(self, addresses):
+        return CallData(
+            addresses,
+            addresses.intern_all(self.addresses.get_rows(self.caller_ids)),
+            self.features,
+            { name: getattr(self, name) for name in SCALAR_COLUMNS },
+            self.weights,
+        )
+
+    # Approximate call counts to a method feature, one per row.
+    def method_calls(self, feature):
+        return self.features[:, FEATURES.index(feature)] * self.total_calls
+
+    @staticmethod
+    def concatenate(call_datas):
+        addresses = call_datas[0].addresses
+        if not all(d.addresses is addresses for d in call_datas):
+            # Only the callers actually referenced are copied over, so tables
+            # don't pile up rows that were selected away.
+            addresses = AddressTable()
+            call_datas = [ d.with_addresses(addresses) for d in call_datas ]
+            addresses.trim()
+        return CallData(
+            addresses,
+            np.concatenate([ d.caller_ids for d in call_datas ]),
+            np.concatenate([ d.features for d in call_datas ]),
+            {
+                name: np.concatenate([ getattr(d, name) for d in call_datas ])
+                for name in SCALAR_COLUMNS
+            },
+            np.concatenate([ d.weights for d in call_datas ]),
+        )
+
+    @staticmethod
+    def from_records(records):
+        builder = CallDataBuilder()
+        for data in records:
+            builder.append(data)
+        return builder.build()
+
+# Fills `CallData` columns from raw parsed records (as produced by the parse
+# step), one record at a time.
+class CallDataBuilder:
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._addresses = AddressTable(capacity=capacity)
+        self._caller_ids = np.zeros(capacity, dtype=ID_DTYPE)
+        self._features = np.zeros((capacity, len(FEATURES)))
+        self._columns = {
+            name: np.zeros(capacity, dtype=np.int64) for name in SCALAR_COLUMNS
+        }
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        capacity = max(1, 2 * len(self._caller_ids))
+        self._caller_ids = _resized(self._caller_ids, capacity)
+        self._features = _resized(self._features, capacity)
+        self._columns = {
+            name: _resized(col, capacity) for (name, col) in self._columns.items()
+        }
+
+    # Same as `parse_cluster_data_item()` + `to_features()`, but written
+    # straight into the columns.
+    def append(self, data):
+        i = self._size
+        if i == len(self._caller_ids):
+            self._grow()
+        caller_id = self._addresses.intern(data['caller'])
+        methods = data['methods']
+        total_method_calls = sum(methods.values())
+        row = self._features[i]
+        for (method, count) in methods.items():
+            j = METHOD_FEATURE_INDICES.get(method)
+            if j is not None:
+                row[j] = count / total_method_calls
+        columns = self._columns
+        (
+            columns['unique_senders'][i],
+            columns['unique_fee_recipients'][i],
+            columns['unique_makers'][i],
+        ) = get_unique_counts(data)
+        columns['total_calls'][i] = total_method_calls
+        columns['total_orders'][i] = data['updateCount']
+        columns['total_fills'][i] = data['fillCount']
+        columns['max_calls'][i] = max(methods.values())
+        self._caller_ids[i] = caller_id
+        self._size += 1
+
+    def build(self):
+        n = self._size
+        features = self._features[:n]
+        columns = { name: col[:n] for (name, col) in self._columns.items() }
+        for (j, feature) in enumerate(FEATURES):
+            if feature in columns:
+                col = columns[feature]
+                features[:, j] = softsign(col) if feature in SOFTSIGN_COLUMNS else col
+        self._addresses.trim()
+        return CallData(self._addresses, self._caller_ids[:n], features, columns)
+
+def _resized(arr, capacity):
+    resized = np.zeros((capacity, *arr.shape[1:]), dtype=arr.dtype)
+    resized[:len(arr)] = arr[:capacity]
+    return resized
+
+def _count_lines(file):
+    with open(file, 'rb') as f:
+        count = 0
+        last = b'\n'
+        for buf in iter(lambda: f.read(1 << 20), b''):
+            count += buf.count(b'\n')
+            last = buf[-1:]
+        return count + (last != b'\n')
+
+# Raw parsed records from a call data file or a day snapshot window spec
+# (`DIR@SINCE..UNTIL`, see `snapshots.py`).
+def _iter_cluster_data_records(file):
+    if is_window_spec(file):
+        yield from iter_window_records(file)
+        return
     with open(file) as f:
-        return [ parse_cluster_data_item(json.loads(line)) for line in f ]
+        for line in f:
+            yield json.loads(line)
+
+def _parse_cluster_data_file(file):
+    builder = CallDataBuilder(capacity=1024 if is_window_spec(file) else _count_lines(file))
+    for data in metrics.timed_iter('read_records', _iter_cluster_data_records(file)):
+        builder.append(data)
+    with metrics.span('build_features'):
+        return builder.build()
+
+# Parsed call data is cached as `.npy` columns in a `FILE.cache` directory
+# next to the call data file. `key.json` identifies the source file and the
+# feature schema the columns were built from.
+def _get_cache_dir(file):
+    return file + '.cache'
+
+def _get_cache_key(file):
+    stat = os.stat(file)
+    return {
+        'path': os.path.abspath(file),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'features': FEATURES,
+        'features_version': FEATURES_VERSION,
+        'columns': list(SCALAR_COLUMNS),
+    }
+
+def _load_cached_call_data(file):
+    cache_dir = _get_cache_dir(file)
+    try:
+        with open(os.path.join(cache_dir, 'key.json')) as f:
+            if json.load(f) != _get_cache_key(file):
+                return None
+        load = lambda name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+        return CallData(
+            AddressTable(load('addresses')),
+            load('callers'),
+            load('features'),
+            { name: load(name) for name in SCALAR_COLUMNS },
+            load('weights'),
+        )
+    except (OSError, ValueError):
+        return None
+
+def _save_cached_call_data(file, call_data):
+    cache_dir = _get_cache_dir(file)
+    key_file = os.path.join(cache_dir, 'key.json')
+    os.makedirs(cache_dir, exist_ok=True)
+    # Invalidate the old cache before touching any of its columns.
+    if os.path.exists(key_file):
+        os.remove(key_file)
+    columns = {
+        'addresses': call_data.addresses.buffer,
+        'callers': call_data.caller_ids,
+        'features': call_data.features,
+        'weights': call_data.weights,
+        **{ name: getattr(call_data, name) for name in SCALAR_COLUMNS },
+    }
+    for (name, col) in columns.items():
+        path = os.path.join(cache_dir, name + '.npy')
+        np.save(path + '.tmp.npy', np.ascontiguousarray(col))
+        os.replace(path + '.tmp.npy', path)
+    with open(key_file + '.tmp', 'w') as f:
+        json.dump(_get_cache_key(file), f)
+    os.replace(key_file + '.tmp', key_file)
+
+# Load a parsed call data file, or a window of day snapshots. If `cache` is
+# set, the columns are memory-mapped from a previous run's cache, if it's still
+# valid, or cached for next time (windows aren't cached).
+def load_cluster_data(file, cache=True):
+    with metrics.span('load_call_data'):
+        call_data = _load_cluster_data(file, cache)
+        metrics.count('call_data_rows', len(call_data))
+        return call_data
+
+def _load_cluster_data(file, cache):
+    cache = cache and not is_window_spec(file)
+    if cache:
+        with metrics.span('read_cache'):
+            call_data = _load_cached_call_data(file)
+        if call_data is not None:
+            return call_data
+    with metrics.span('parse'):
+        call_data = _parse_cluster_data_file(file)
+    if cache:
+        try:
+            with metrics.span('write_cache'):
+                _save_cached_call_data(file, call_data)
+        except OSError as err:
+            print('Could not cache call data: %s' % err)
+    return call_data
+
+# Stream a parsed call data file as `CallData` chunks of up to `chunk_size`
+# rows. If there is a valid cache for the file, chunks are sliced from the
+# memory-mapped cache instead.
+def iter_cluster_data(file, chunk_size=100000, cache=True):
+    if cache and not is_window_spec(file):
+        call_data = _load_cached_call_data(file)
+        if call_data is not None:
+            for i in range(0, len(call_data), chunk_size):
+                yield call_data[i:i + chunk_size]
+            return
+    builder = CallDataBuilder(capacity=chunk_size)
+    for data in _iter_cluster_data_records(file):
+        builder.append(data)
+        if len(builder) == chunk_size:
+            yield builder.build()
+            builder = CallDataBuilder(capacity=chunk_size)
+    if len(builder):
+        yield builder.build()
+
+# Draw a uniform sample of up to `sample_size` rows from a stream of
+# `CallData` chunks, by keeping the rows with the smallest random keys.
+# Returns the sample and the total number of rows seen.
+def sample_cluster_data(chunks, sample_size, seed=1337):
+    rng = np.random.RandomState(seed)
+    sample = None
+    sample_keys = None
+    num_rows = 0
+    # The sample's callers are interned in one table as they come in, and
+    # only candidate rows are interned at all.
+    addresses = AddressTable()
+    for chunk in chunks:
+        num_rows += len(chunk)
+        keys = rng.random_sample(len(chunk))
+        if sample is not None and len(sample) == sample_size:
+            # Only rows with smaller keys than the sample's biggest can get in.
+            is_candidate = keys < sample_keys.max()
+            chunk, keys = chunk[is_candidate], keys[is_candidate]
+        chunk, keys = _smallest_keys(chunk, keys, sample_size)
+        chunk = chunk.with_addresses(addresses)
+        if sample is not None:
+            chunk, keys = _smallest_keys(
+                CallData.concatenate([ sample, chunk ]),
+                np.concatenate([ sample_keys, keys ]),
+                sample_size,
+            )
+        sample, sample_keys = chunk, keys
+    if sample is not None:
+        # Drop the callers that were sampled, then pushed out again.
+        sample = sample.with_addresses(AddressTable())
+        sample.addresses.trim()
+    return sample, num_rows
+
+# Keep the rows with the `size` smallest keys, in their original order.
+def _smallest_keys(call_data, keys, size):
+    if len(call_data) <= size:
+        return call_data, keys
+    keep = np.sort(np.argpartition(keys, size)[:size])
+    return call_data[keep], keys[keep]
+
+# The feature matrix that models are fit on (or predict), as one C-contiguous
+# array, which is only copied if it has to be. With `float32`, features are
+# converted to single precision, which halves the model's working set. The
+# call data itself keeps its float64 features, for reports and plots.
+def get_model_features(call_data, float32=False):
+    return np.ascontiguousarray(call_data.features, dtype=np.float32 if float32 else np.float64)
+
+# Find the unique rows of a (numeric) matrix, returning them and the index
+# of each row's unique row. Comparing rows as raw bytes is much faster than
+# `np.unique(..., axis=0)`, but orders the unique rows arbitrarily.
+def unique_rows(arr):
+    # Adding zero turns any -0.0 into 0.0, so they have the same bytes.
+    arr = np.ascontiguousarray(arr + arr.dtype.type(0))
+    rows = arr.view(np.dtype((np.void, arr.dtype.itemsize * arr.shape[1]))).reshape(-1)
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return arr[first], inverse.reshape(-1)
+
+# Collapse identical feature rows (or rows that are identical once rounded to
+# `decimals` places) into one, summing their weights. Returns the unique rows,
+# their weights, and the index of each row's unique row, so results can be
+# scattered back with `results[inverse]`.
+def dedup_rows(features, weights, decimals=None):
+    features = np.asarray(features)
+    if decimals is not None:
+        features = np.round(features, decimals)
+    unique_features, inverse = unique_rows(features)
+    unique_weights = np.bincount(
+        inverse,
+        weights=np.asarray(weights).reshape(-1),
+        minlength=len(unique_features),
+    )
+    metrics.count('dedup_rows', len(features))
+    metrics.count('dedup_unique_rows', len(unique_features))
+    return unique_features, unique_weights, inverse
 
 def label_to_classs_name(label):
     name = CLASS_NAMES[label % len(CLASS_NAMES)] if label >= 0 else 'WILDLINGS'
@@ -96,76 +465,117 @@ def label_to_classs_name(label):
         name = '%s_%d' % (name, label // len(CLASS_NAMES))
     return name
 
+# Split call data by label, in the order labels are first seen. Rows are
+# grouped with one (stable) sort rather than a scan per label.
 def split_by_labels(call_data, labels, numeric=False):
+    labels = np.asarray(labels)
+    unique_labels, first_idx, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    order = np.argsort(inverse.reshape(-1), kind='stable')
+    bounds = np.searchsorted(inverse.reshape(-1)[order], np.arange(len(unique_labels) + 1))
     return {
-        label if numeric else label_to_classs_name(label) : [
-            d
-            for (d, dl)
-            in zip(call_data, labels)
-            if dl == label
-        ]
-        for label in labels
+        int(unique_labels[i]) if numeric else label_to_classs_name(unique_labels[i]) :
+            call_data[order[bounds[i]:bounds[i + 1]]]
+        for i in np.argsort(first_idx)
     }
 
 # Attenuates feature columns by normal distribution.
+# `values` may be a single column or a (contiguous) 2D array of columns, one
+# per row.
 def attenuate_values(values, factor=1):
-    mean = np.mean(values)
-    std = np.std(values)
-    if std > 0:
-        return [
-            n * ((1 - factor) + factor * scipy.stats.norm.pdf((n - mean) / std))
-            for n in values
-        ]
-    return values
+    values = np.asarray(values)
+    mean = np.mean(values, axis=-1, keepdims=True)
+    std = np.std(values, axis=-1, keepdims=True)
+    has_spread = std > 0
+    attenuated = values * (
+        (1 - factor) +
+        factor * scipy.stats.norm.pdf((values - mean) / np.where(has_spread, std, 1))
+    )
+    return np.where(has_spread, attenuated, values)
 
 # Intelligently collapse a cluster's features into a single row.
 def collapse_features(cluster, weights, attenuate=0, brighten=0):
-    cols = list(zip(*cluster))
+    cols = np.ascontiguousarray(np.asarray(cluster, dtype=np.float64).T)
+    return _collapse_columns(cols, np.asarray(weights).reshape(-1), attenuate, brighten)
+
+# Same as `collapse_features()`, but on a cluster's (`FEATURES` x rows)
+# feature columns.
+def _collapse_columns(cols, weights, attenuate=0, brighten=0):
     if attenuate > 0:
-        for i, col in enumerate(cols):
-            cols[i] = attenuate_values(col, attenuate)
-    call_features = frozenset(f for f in FEATURES if f.startswith('calls_to_'))
+        cols = attenuate_values(cols, attenuate)
+    weighted_cols = cols * weights
+    weighted_max = np.max(weighted_cols, axis=1)
+    col_max = np.max(cols, axis=1)
     calls_sum_max = sum(
-        np.max(np.array(col) * weights)
-        for (col, f) in zip(cols, FEATURES)
-        if f in call_features
+        v for (v, f) in zip(weighted_max, FEATURES) if f.startswith('calls_to_')
     )
-    def collapse_column(col, feature):
+    def collapse_column(j, feature):
         if feature == 'unique_senders':
-            return max(col)
+            return col_max[j]
         if feature == 'total_orders':
-            return sum(col)
+            return np.sum(cols[j])
         if feature == 'total_fills':
-            return sum(col)
+            return np.sum(cols[j])
         if feature.startswith('calls_to_'):
-            if np.max(col) > 0:
-                v = np.max([ n * w for (n, w) in zip(col, weights) ])
-                v = (v  / calls_sum_max) ** (1 - brighten)
-                return v
+            if col_max[j] > 0:
+                return (weighted_max[j] / calls_sum_max) ** (1 - brighten)
             return 0
-        return sum([ n * w for (n, w) in zip(col, weights) ]) / sum(weights)
+        return np.sum(weighted_cols[j]) / np.sum(weights)
     return np.array([
-        collapse_column(col, feature)
-        for (col, feature)
-        in zip(cols, FEATURES)
+        collapse_column(j, feature)
+        for (j, feature)
+        in enumerate(FEATURES)
     ])
 
+# Aggregates of call data for each cluster label, computed together from the
+# feature matrix and label array. Rows are grouped by label with one stable
+# sort, and each aggregate is then a reduction over contiguous segments.
+class ClusterSummary:
+    def __init__(self, call_data, labels):
+        with metrics.span('summarise'):
+            self._summarise(call_data, labels)
+
+    def _summarise(self, call_data, labels):
+        labels = np.asarray(labels)
+        # Labels are sorted, like `sorted(frozenset(labels))`.
+        self.labels, inverse, self.sizes = np.unique(
+            labels,
+            return_inverse=True,
+            return_counts=True,
+        )
+        order = np.argsort(inverse.reshape(-1), kind='stable')
+        self._bounds = np.concatenate([ [ 0 ], np.cumsum(self.sizes) ])
+        # Feature columns, one per row, with each cluster's values contiguous.
+        self._cols = np.ascontiguousarray(call_data.features[order].T)
+        self._weights = call_data.weights[order]
+        starts = self._bounds[:-1]
+        segment_sums = lambda values: \
+            np.add.reduceat(values[order], starts, axis=0) if len(order) else np.zeros((0, *values.shape[1:]))
+        self.total_fills = segment_sums(call_data.total_fills)
+        self.total_orders = segment_sums(call_data.total_orders)
+        self.unique_senders = segment_sums(call_data.unique_senders)
+        # Call counts to each method feature (0 for other features), truncated
+        # per caller.
+        is_call = np.array([ f.startswith('calls_to_') for f in FEATURES ])
+        self.method_calls = segment_sums(
+            np.trunc(call_data.features * call_data.total_calls.reshape(-1, 1)) * is_call,
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Collapse each cluster's features into a single row, ordered by label.
+    def collapse(self, attenuate=0, brighten=0):
+        with metrics.span('collapse'):
+            return np.array([
+                _collapse_columns(
+                    self._cols[:, start:end],
+                    self._weights[start:end],
+                    attenuate=attenuate,
+                    brighten=brighten,
+                )
+                for (start, end) in zip(self._bounds[:-1], self._bounds[1:])
+            ])
+
 # Intelligently collapse all clusters.
 def collapse_clusters(call_data, labels, attenuate=0, brighten=0):
-    return np.array([
-        collapse_features(
-            [
-                to_features(row)
-                for (row_label, row) in zip(labels, call_data)
-                if row_label == label
-            ],
-            [
-                to_weight(row)
-                for (row_label, row) in zip(labels, call_data)
-                if row_label == label
-            ],
-            attenuate=attenuate,
-            brighten=brighten,
-        )
-        for label in sorted(frozenset(labels))
-    ])
+    return ClusterSummary(call_data, labels).collapse(attenuate=attenuate, brighten=brighten)
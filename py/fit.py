@@ -1,53 +1,151 @@
+import approx_dbscan
 import argparse
 from clustering_model import ClusteringModel
-from data_utils import load_cluster_data, to_features, to_weight
-import matplotlib.pyplot as plt
-import numpy as np
-from visuals import plot_heatmap
+from data_utils import get_model_features, iter_cluster_data, load_cluster_data, sample_cluster_data
+import metrics
+from plotting import import_plotting, show_or_save
+
+DEFAULT_EPS = 0.15
+DEFAULT_MIN_SAMPLES = 100
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Clusterize exchange and forwarder contract callers')
-    parser.add_argument('-e', '--eps', dest='eps', default=0.15, type=float, help='maximum distance between cluster points for the DBSCAN step')
-    parser.add_argument('-s', '--samples', dest='min_samples', default=100, type=int, help='minimum number of samples for cluster cores for the DBSCAN step')
-    parser.add_argument('-c', '--clusters', dest='num_clusters', default=11, type=int, help='number of final clusters to generate')
+    parser.add_argument('-e', '--eps', dest='eps', default=None, type=float, help='maximum distance between cluster points for the DBSCAN step (default: 0.15, or the refit model\'s)')
+    parser.add_argument('-s', '--samples', dest='min_samples', default=None, type=int, help='minimum number of samples for cluster cores for the DBSCAN step (default: 100, or the refit model\'s)')
+    parser.add_argument('--dbscan-engine', dest='dbscan_engine', default='exact', choices=('exact', 'grid'), help='exact DBSCAN, or approximate DBSCAN on a grid coreset, for big training sets')
+    parser.add_argument('--rho', dest='rho', default=approx_dbscan.DEFAULT_RHO, type=float, help='grid DBSCAN cell diameter, as a fraction of eps')
+    parser.add_argument('--max-cells', dest='max_cells', default=approx_dbscan.DEFAULT_MAX_CELLS, type=int, help='most grid DBSCAN cells, before the grid is coarsened (as long as rho stays under 1)')
+    parser.add_argument('-c', '--clusters', dest='num_clusters', default=11, type=int, help='number of final clusters to generate (ignored when refitting)')
     parser.add_argument('-d', '--dendrogram', dest='draw_dendrogram', default=False, action='store_true', help='draw the dendrogram')
     parser.add_argument('--attenuate', dest='attenuate', default=0.5, type=float, help='attenuation factor for collapsed clusters')
     parser.add_argument('--brighten', dest='brighten', default=0.625, type=float, help='brightening factor for collapsed clusters')
     parser.add_argument('--linear', dest='linear_scale', default=False, action='store_true', help='draw bar plots in linear scale')
     parser.add_argument('--save', dest='save_file', default=None, type=str, help='save trained clustering model to a file')
-    parser.add_argument(dest='call_data_file', type=str, help='the call data file')
+    parser.add_argument('--refit', dest='refit_file', default=None, type=str, help='warm-start from an existing model file, keeping its labels and heatmap ordering')
+    parser.add_argument('--streaming', dest='streaming', default=False, action='store_true', help='train out-of-core, on chunks of the call data, with mini-batch KMeans')
+    parser.add_argument('--chunk-size', dest='chunk_size', default=100000, type=int, help='rows per chunk in streaming mode')
+    parser.add_argument('--sample-size', dest='sample_size', default=200000, type=int, help='rows sampled for the DBSCAN step in streaming mode')
+    parser.add_argument('--epochs', dest='epochs', default=1, type=int, help='passes over the call data for mini-batch KMeans in streaming mode')
+    parser.add_argument('--no-plot', dest='plot', default=True, action='store_false', help='do not plot (or import the plotting libraries)')
+    parser.add_argument('--plot-file', dest='plot_file', default=None, type=str, help='save the plot to a (.png, .svg, ...) file instead of showing it')
+    parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false', help='do not read or write the parsed call data cache')
+    parser.add_argument('--dedup', dest='dedup', default=False, action='store_true', help='fit each distinct feature row only once, with the summed weight of its callers (--streaming and --refit fits are unaffected)')
+    parser.add_argument('--dedup-decimals', dest='dedup_decimals', default=None, type=int, help='with --dedup, also merge rows that are the same when rounded to this many decimal places')
+    parser.add_argument('--float32', dest='float32', default=False, action='store_true', help='fit on single precision features, to halve their memory')
+    metrics.add_arguments(parser)
+    parser.add_argument(dest='call_data_file', type=str, help='the call data file, or a day snapshot window (DIR@SINCE..UNTIL)')
     args = parser.parse_args()
+    if args.refit_file and args.streaming:
+        parser.error('--refit cannot be used with --streaming')
+    if args.dbscan_engine == 'grid' and not 0 < args.rho < 1:
+        parser.error('--rho must be between 0 and 1')
+    metrics.enable_from_args(args)
+    engine_args = {}
+    if args.dbscan_engine == 'grid':
+        engine_args = { 'rho': args.rho, 'max_cells': args.max_cells }
 
-    call_data = load_cluster_data(args.call_data_file)
-    print(f'Loaded {len(call_data)} call data entries.')
+    model = ClusteringModel()
+    if args.refit_file:
+        model = ClusteringModel.load_from_file(args.refit_file)
+        call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
+        print(f'Loaded {len(call_data)} call data entries.')
 
-    features = np.array([ to_features(x) for x in call_data ])
-    weights = np.array([ to_weight(d) for d in call_data ]).reshape(-1, 1)
+        num_cores = len(model.dbscan_model.components_)
+        labels = model.refit(
+            get_model_features(call_data, args.float32),
+            weights=call_data.weights.reshape(-1, 1),
+            eps=args.eps,
+            min_samples=args.min_samples,
+        )
+        print('Refit %s (%d -> %d DBSCAN cores).' % (
+            args.refit_file,
+            num_cores,
+            len(model.dbscan_model.components_),
+        ))
+    elif args.streaming:
+        get_chunks = lambda: iter_cluster_data(
+            args.call_data_file,
+            chunk_size=args.chunk_size,
+            cache=args.use_cache,
+        )
+        # Only a sample of the call data is held in memory, which is used for
+        # the DBSCAN step and the heatmap.
+        call_data, num_rows = sample_cluster_data(get_chunks(), args.sample_size)
+        print(f'Sampled {len(call_data)} of {num_rows} call data entries.')
 
-    model = ClusteringModel()
-    labels = model.fit(
-        features,
-        weights=weights,
-        num_clusters=args.num_clusters,
-        eps=args.eps,
-        min_samples=args.min_samples,
-    )
+        model.fit_streaming(
+            get_model_features(call_data, args.float32),
+            call_data.weights,
+            len(call_data) / num_rows,
+            lambda: ((get_model_features(c, args.float32), c.weights) for c in get_chunks()),
+            num_clusters=args.num_clusters,
+            eps=args.eps if args.eps is not None else DEFAULT_EPS,
+            min_samples=args.min_samples if args.min_samples is not None else DEFAULT_MIN_SAMPLES,
+            epochs=args.epochs,
+            dbscan_engine=args.dbscan_engine,
+            **engine_args,
+        )
+        labels = model.predict(
+            get_model_features(call_data, args.float32),
+            weights=call_data.weights.reshape(-1, 1),
+            dedup=args.dedup,
+            dedup_decimals=args.dedup_decimals,
+        )
+    else:
+        call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
+        print(f'Loaded {len(call_data)} call data entries.')
+
+        features = get_model_features(call_data, args.float32)
+        weights = call_data.weights
+
+        labels = model.fit(
+            features,
+            weights=weights,
+            num_clusters=args.num_clusters,
+            eps=args.eps if args.eps is not None else DEFAULT_EPS,
+            min_samples=args.min_samples if args.min_samples is not None else DEFAULT_MIN_SAMPLES,
+            dbscan_engine=args.dbscan_engine,
+            dedup=args.dedup,
+            dedup_decimals=args.dedup_decimals,
+            **engine_args,
+        )
+    rho = getattr(model.dbscan_model, 'rho', None)
+    if rho is not None:
+        print('Grid DBSCAN used rho = %g%s.' % (
+            rho,
+            ' (coarsened from %g to fit --max-cells)' % args.rho if rho > args.rho else '',
+        ))
     unique_labels = frozenset(labels)
     print('Found %d labels.' % len(unique_labels))
 
-    ordering = plot_heatmap(
-        call_data,
-        labels,
-        draw_dendrogram=args.draw_dendrogram,
-        linear_scale=args.linear_scale,
-        attenuate=args.attenuate,
-        brighten=args.brighten,
-        title=args.call_data_file,
-    )
+    # Without a plot, there's no heatmap ordering to save with the model.
+    # `predict` will then work out its own. Refits keep the old ordering.
+    ordering = (None, None)
+    if args.refit_file:
+        ordering = (getattr(model, 'viz_column_ordering', None), getattr(model, 'viz_row_ordering', None))
+        if ordering[0] is not None and len(ordering[0]) != len(unique_labels):
+            print('Clusters have changed, so the heatmap column ordering will be recomputed.')
+            ordering = (None, ordering[1])
+    if args.plot:
+        with metrics.span('plot'):
+            plt, visuals = import_plotting(headless=args.plot_file is not None)
+            ordering = visuals.plot_heatmap(
+                call_data,
+                labels,
+                draw_dendrogram=args.draw_dendrogram,
+                linear_scale=args.linear_scale,
+                attenuate=args.attenuate,
+                brighten=args.brighten,
+                title=args.call_data_file,
+                col_ordering=ordering[0],
+                row_ordering=ordering[1],
+            )
 
     if args.save_file:
         model.viz_column_ordering, model.viz_row_ordering = ordering
         model.save_to_file(args.save_file)
         print('Saved model to %s' % args.save_file)
 
-    plt.show()
+    metrics.write_from_args(args)
+    if args.plot:
+        show_or_save(plt, args.plot_file)
@@ -1,37 +1,140 @@
 import argparse
 from clustering_model import ClusteringModel
-from data_utils import load_cluster_data, to_features, to_weight
-import matplotlib.pyplot as plt
-import numpy as np
-from visuals import plot_heatmap
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from data_utils import load_cluster_data
+import json
+import metrics
+import os
+from plotting import import_plotting, show_or_save
+
+TABLE_COLUMNS = ('clusters', 'inertia', 'eps', 'min_samples', 'n_init')
+
+# Non-outlier features and weights shared by the sweep workers.
+_sweep_data = None
+
+def _init_sweep_worker(features, weights):
+    global _sweep_data
+    _sweep_data = (features, weights)
+
+def _fit_inertia(num_clusters, n_init):
+    features, weights = _sweep_data
+    # One cluster is reserved for outliers.
+    kmeans_model = ClusteringModel.fit_kmeans(
+        features,
+        weights,
+        num_clusters - 1,
+        n_init=n_init,
+    )
+    return num_clusters, float(kmeans_model.inertia_)
+
+def is_json_table(file):
+    return os.path.splitext(file)[1].lower() == '.json'
+
+# Read rows from a previous (possibly interrupted) sweep.
+def read_table(file):
+    if not os.path.exists(file):
+        return []
+    with open(file) as f:
+        if is_json_table(file):
+            return json.load(f)
+        return [
+            {
+                'clusters': int(row['clusters']),
+                'inertia': float(row['inertia']),
+                'eps': float(row['eps']),
+                'min_samples': int(row['min_samples']),
+                'n_init': int(row['n_init']),
+            }
+            for row in csv.DictReader(f)
+        ]
+
+def write_table(file, rows):
+    rows = sorted(rows, key=lambda r: r['clusters'])
+    with open(file + '.tmp', 'w', newline='') as f:
+        if is_json_table(file):
+            json.dump(rows, f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(file + '.tmp', file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Clusterize exchange and forwarder contract callers')
     parser.add_argument('-e', '--eps', dest='eps', default=0.15, type=float, help='maximum distance between cluster points for the DBSCAN step')
     parser.add_argument('-s', '--samples', dest='min_samples', default=100, type=int, help='minimum number of samples for cluster cores for the DBSCAN step')
-    parser.add_argument(dest='call_data_file', type=str, help='the call data file')
+    parser.add_argument('--min-clusters', dest='min_clusters', default=2, type=int, help='smallest number of final clusters to try')
+    parser.add_argument('--max-clusters', dest='max_clusters', default=23, type=int, help='largest number of final clusters to try')
+    parser.add_argument('--n-init', dest='n_init', default=100, type=int, help='number of KMeans initializations per cluster count')
+    parser.add_argument('-j', '--workers', dest='workers', default=os.cpu_count(), type=int, help='number of worker processes')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='write the inertia table to a CSV (or .json) file, resuming from it if it exists')
+    parser.add_argument('--no-plot', dest='plot', default=True, action='store_false', help='do not plot (or import the plotting libraries)')
+    parser.add_argument('--plot-file', dest='plot_file', default=None, type=str, help='save the plot to a (.png, .svg, ...) file instead of showing it')
+    parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false', help='do not read or write the parsed call data cache')
+    metrics.add_arguments(parser)
+    parser.add_argument(dest='call_data_file', type=str, help='the call data file, or a day snapshot window (DIR@SINCE..UNTIL)')
     args = parser.parse_args()
+    metrics.enable_from_args(args)
+
+    params = { 'eps': args.eps, 'min_samples': args.min_samples, 'n_init': args.n_init }
+    clusters = list(range(args.min_clusters, args.max_clusters + 1))
+    rows = []
+    if args.output_file:
+        rows = [
+            r for r in read_table(args.output_file)
+            if r['clusters'] in clusters and all(r[k] == v for (k, v) in params.items())
+        ]
+        if rows:
+            print('Resuming with %d cluster counts from %s.' % (len(rows), args.output_file))
+    remaining = sorted(frozenset(clusters) - frozenset(r['clusters'] for r in rows))
+
+    if remaining:
+        call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
+        print(f'Loaded {len(call_data)} call data entries.')
+
+        features = call_data.features
+        weights = call_data.weights.reshape(-1, 1)
+
+        # The DBSCAN step doesn't depend on the number of clusters, so fit it
+        # only once.
+        model = ClusteringModel()
+        with metrics.span('dbscan'):
+            dbscan_labels = model.fit_outliers(
+                features,
+                weights,
+                eps=args.eps,
+                min_samples=args.min_samples,
+            )
+        non_outlier_features, non_outlier_weights = \
+            ClusteringModel._get_non_outliers(features, weights, dbscan_labels)
+        print(f'Found {len(features) - len(non_outlier_features)} outliers.')
+
+        with metrics.span('kmeans_sweep'), ProcessPoolExecutor(
+                max_workers=min(args.workers, len(remaining)),
+                initializer=_init_sweep_worker,
+                initargs=(non_outlier_features, non_outlier_weights),
+            ) as executor:
+            futures = [
+                executor.submit(_fit_inertia, i, args.n_init)
+                for i in remaining
+            ]
+            for future in as_completed(futures):
+                num_clusters, inertia = future.result()
+                print(f'{num_clusters} clusters: inertia = {inertia}')
+                rows.append({ 'clusters': num_clusters, 'inertia': inertia, **params })
+                if args.output_file:
+                    write_table(args.output_file, rows)
+
+    if args.output_file:
+        print('Wrote inertia table to %s.' % args.output_file)
+    metrics.write_from_args(args)
 
-    call_data = load_cluster_data(args.call_data_file)
-    print(f'Loaded {len(call_data)} call data entries.')
-
-    features = np.array([ to_features(x) for x in call_data ])
-    weights = np.array([ to_weight(d) for d in call_data ]).reshape(-1, 1)
-
-    model = ClusteringModel()
-    clusters = list(range(2, 24))
-    inertias = []
-    for i in clusters:
-        model.fit(
-            features,
-            weights=weights,
-            num_clusters=i,
-            eps=args.eps,
-            min_samples=args.min_samples,
-        )
-        inertias.append(model.kmeans_model.inertia_)
-    plt.plot(clusters, inertias)
-    plt.suptitle('inertia with cluster count')
-    plt.xlabel('# of clusters')
-    plt.ylabel('inertia')
-    plt.show()
+    if args.plot:
+        plt, _ = import_plotting(headless=args.plot_file is not None)
+        rows = sorted(rows, key=lambda r: r['clusters'])
+        plt.plot([ r['clusters'] for r in rows ], [ r['inertia'] for r in rows ])
+        plt.suptitle('inertia with cluster count')
+        plt.xlabel('# of clusters')
+        plt.ylabel('inertia')
+        show_or_save(plt, args.plot_file)
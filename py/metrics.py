@@ -0,0 +1,243 @@
+import contextlib
+from datetime import datetime, timezone
+import json
+import re
+import resource
+import sys
+import time
+
+# Opt-in instrumentation for the pipeline: timed (and memory-tracked) spans,
+# counters and gauges, collected into a run report.
+# Everything is a no-op until `enable()` is called, so instrumented code only
+# pays for a global lookup when metrics are off.
+_recorder = None
+_NULL_SPAN = contextlib.nullcontext()
+
+class _Recorder:
+    def __init__(self, trace_memory=False, profile=False):
+        self.started = datetime.now(timezone.utc)
+        self.spans = {}
+        self.counters = {}
+        self.gauges = {}
+        self.stack = []
+        self.trace_memory = trace_memory
+        self.profiler = None
+        if trace_memory:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+            tracemalloc.start()
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def record_span(self, name, seconds, cpu_seconds, rss_growth, traced_peak=None):
+        span = self.spans.get(name)
+        if span is None:
+            span = self.spans[name] = {
+                'count': 0,
+                'seconds': 0.,
+                'cpu_seconds': 0.,
+                'max_seconds': 0.,
+                'rss_growth_mb': 0.,
+            }
+        span['count'] += 1
+        span['seconds'] += seconds
+        span['cpu_seconds'] += cpu_seconds
+        span['max_seconds'] = max(span['max_seconds'], seconds)
+        span['rss_growth_mb'] += rss_growth
+        if traced_peak is not None:
+            span['traced_peak_mb'] = max(span.get('traced_peak_mb', 0.), traced_peak)
+
+class _Span:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        recorder = self.recorder
+        self.path = '/'.join([ *(s.name for s in recorder.stack), self.name ])
+        if recorder.trace_memory:
+            # Track this span's own peak, then fold it into the parent's.
+            _, peak = recorder.tracemalloc.get_traced_memory()
+            if recorder.stack:
+                parent = recorder.stack[-1]
+                parent.traced_peak = max(parent.traced_peak, peak)
+            recorder.tracemalloc.reset_peak()
+            self.traced_peak = 0
+        recorder.stack.append(self)
+        self.max_rss = _get_max_rss_mb()
+        self.cpu_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        cpu_seconds = time.process_time() - self.cpu_start
+        recorder = self.recorder
+        recorder.stack.pop()
+        traced_peak = None
+        if recorder.trace_memory:
+            _, peak = recorder.tracemalloc.get_traced_memory()
+            self.traced_peak = max(self.traced_peak, peak)
+            traced_peak = self.traced_peak / 2**20
+            if recorder.stack:
+                parent = recorder.stack[-1]
+                parent.traced_peak = max(parent.traced_peak, self.traced_peak)
+        recorder.record_span(
+            self.path,
+            seconds,
+            cpu_seconds,
+            _get_max_rss_mb() - self.max_rss,
+            traced_peak,
+        )
+        return False
+
+# The peak RSS of this process so far (`ru_maxrss` is in KB on linux, but
+# bytes on macOS).
+def _get_max_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+def enable(trace_memory=False, profile=False):
+    global _recorder
+    _recorder = _Recorder(trace_memory=trace_memory, profile=profile)
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        if _recorder.profiler is not None:
+            _recorder.profiler.disable()
+        if _recorder.trace_memory:
+            _recorder.tracemalloc.stop()
+    _recorder = None
+
+def is_enabled():
+    return _recorder is not None
+
+# Time a block as a named stage, nested under any enclosing spans:
+#   with metrics.span('dbscan'):
+#       ...
+def span(name):
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name)
+
+def count(name, value=1):
+    if _recorder is not None:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + value
+
+def gauge(name, value):
+    if _recorder is not None:
+        _recorder.gauges[name] = value
+
+# Wrap an iterator so the time spent producing its items is recorded as a
+# span (of `count` items). Returns the iterator as-is when disabled.
+def timed_iter(name, items):
+    if _recorder is None:
+        return items
+    return _timed_iter(_recorder, name, items)
+
+def _timed_iter(recorder, name, items):
+    path = '/'.join([ *(s.name for s in recorder.stack), name ])
+    seconds = 0.
+    cpu_seconds = 0.
+    num_items = 0
+    items = iter(items)
+    try:
+        while True:
+            t = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - t
+                cpu_seconds += time.process_time() - cpu
+            num_items += 1
+            yield item
+    finally:
+        recorder.record_span(path, seconds, cpu_seconds, 0.)
+        count(name + '_items', num_items)
+
+def get_report():
+    recorder = _recorder
+    return {
+        'started': recorder.started.isoformat(),
+        'seconds': (datetime.now(timezone.utc) - recorder.started).total_seconds(),
+        'command': sys.argv,
+        'max_rss_mb': _get_max_rss_mb(),
+        'spans': recorder.spans,
+        'counters': recorder.counters,
+        'gauges': recorder.gauges,
+    }
+
+def write_report(file):
+    with open(file, 'w') as f:
+        json.dump(get_report(), f, indent=2)
+
+def _to_metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+# Write the report in Prometheus' text exposition format (e.g., for the node
+# exporter's textfile collector).
+def write_prometheus(file, prefix='user_clusters'):
+    report = get_report()
+    lines = []
+    def add(name, help_text, samples):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+        lines.append('# TYPE %s_%s gauge' % (prefix, name))
+        for (labels, value) in samples:
+            lines.append('%s_%s%s %s' % (prefix, name, labels, repr(float(value))))
+    spans = report['spans']
+    span_label = lambda name: '{span="%s"}' % name.replace('\\', '\\\\').replace('"', '\\"')
+    add('span_seconds', 'Wall time spent in each stage.', [
+        (span_label(n), s['seconds']) for (n, s) in spans.items()
+    ])
+    add('span_cpu_seconds', 'CPU time spent in each stage.', [
+        (span_label(n), s['cpu_seconds']) for (n, s) in spans.items()
+    ])
+    add('span_count', 'Number of times each stage ran.', [
+        (span_label(n), s['count']) for (n, s) in spans.items()
+    ])
+    add('span_rss_growth_megabytes', 'Growth in peak RSS during each stage.', [
+        (span_label(n), s['rss_growth_mb']) for (n, s) in spans.items()
+    ])
+    for (name, value) in report['counters'].items():
+        add(_to_metric_name(name), 'Counter %s.' % name, [ ('', value) ])
+    for (name, value) in report['gauges'].items():
+        add(_to_metric_name(name), 'Gauge %s.' % name, [ ('', value) ])
+    add('run_seconds', 'Total run time.', [ ('', report['seconds']) ])
+    add('max_rss_megabytes', 'Peak RSS of the run.', [ ('', report['max_rss_mb']) ])
+    with open(file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def write_profile(file):
+    if _recorder is not None and _recorder.profiler is not None:
+        _recorder.profiler.disable()
+        _recorder.profiler.dump_stats(file)
+
+# Command line options shared by the scripts.
+def add_arguments(parser):
+    parser.add_argument('--metrics', dest='metrics_file', default=None, type=str, help='write a JSON report of per-stage timings and counts to this file')
+    parser.add_argument('--prometheus', dest='prometheus_file', default=None, type=str, help='also write the report in Prometheus text format to this file')
+    parser.add_argument('--profile', dest='profile_file', default=None, type=str, help='profile the run with cProfile and save the stats to this file')
+    parser.add_argument('--trace-memory', dest='trace_memory', default=False, action='store_true', help='track peak python memory per stage with tracemalloc (slow)')
+
+def enable_from_args(args):
+    if args.metrics_file or args.prometheus_file or args.profile_file:
+        enable(trace_memory=args.trace_memory, profile=args.profile_file is not None)
+
+def write_from_args(args):
+    if not is_enabled():
+        return
+    if args.profile_file:
+        write_profile(args.profile_file)
+        print('Wrote profile to %s.' % args.profile_file)
+    if args.metrics_file:
+        write_report(args.metrics_file)
+        print('Wrote metrics to %s.' % args.metrics_file)
+    if args.prometheus_file:
+        write_prometheus(args.prometheus_file)
+        print('Wrote prometheus metrics to %s.' % args.prometheus_file)
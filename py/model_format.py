@@ -0,0 +1,66 @@
+import json
+import numpy as np
+import struct
+
+# Model files are laid out as:
+#   MAGIC | version (u32) | header length (u32) | JSON header | arrays
+# The JSON header holds scalar model parameters plus the dtype, shape and
+# offset of each array. Arrays are stored raw (C-order) at 64-byte aligned
+# offsets, relative to the (aligned) end of the header, so they can be
+# memory-mapped straight out of the file.
+MAGIC = b'0XUCMODL'
+VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sII')
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def is_model_file(file):
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def write_model_file(file, params, arrays):
+    arrays = { k: np.ascontiguousarray(v) for (k, v) in arrays.items() }
+    layout = {}
+    offset = 0
+    for (name, arr) in arrays.items():
+        layout[name] = {
+            'dtype': arr.dtype.str,
+            'shape': list(arr.shape),
+            'offset': offset,
+        }
+        offset = _align(offset + arr.nbytes)
+    header = json.dumps({ 'params': params, 'arrays': layout }).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header))
+    with open(file, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for (name, arr) in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            arr.tofile(f)
+
+# Returns the model params and a dict of (read-only, memory-mapped) arrays.
+def read_model_file(file):
+    with open(file, 'rb') as f:
+        magic, version, header_size = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError('%s is not a model file' % file)
+        if version > VERSION:
+            raise ValueError('unsupported model file version: %d' % version)
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    data_start = _align(_PREAMBLE.size + header_size)
+    arrays = {}
+    for (name, info) in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=info['dtype'])
+            continue
+        arrays[name] = np.memmap(
+            file,
+            dtype=info['dtype'],
+            mode='r',
+            offset=data_start + info['offset'],
+            shape=shape,
+        )
+    return header['params'], arrays
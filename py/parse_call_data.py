@@ -0,0 +1,341 @@
+from addresses import AddressTable
+import argparse
+from call_decoder import CallDecodeError, CallDecoder, load_default_abi, to_checksum_address
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import heapq
+import json
+import os
+import pickle
+import re
+from sketches import DEFAULT_PRECISION, compact_record, is_compact_record, merge_compact_counts
+import sys
+import tempfile
+import time
+import zlib
+
+TIME_UNITS = {
+    'second': 1,
+    'minute': 60,
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+    'week': 7 * 24 * 60 * 60,
+    'month': 30 * 24 * 60 * 60,
+    'year': 365 * 24 * 60 * 60,
+}
+PROGRESS_INTERVAL = 100000
+
+# Parse a unix timestamp, an ISO date, or something like '6 months ago'.
+def parse_time(text):
+    if re.match(r'^\d+(\.\d*)?$', text):
+        return float(text)
+    m = re.match(r'^(\d+)\s+(second|minute|hour|day|week|month|year)s?\s+ago$', text.strip())
+    if m:
+        return time.time() - int(m.group(1)) * TIME_UNITS[m.group(2)]
+    return datetime.fromisoformat(text).timestamp()
+
+def new_caller_record(caller):
+    # Same key order as `parse-call-data.js` produces.
+    return {
+        'senders': {},
+        'methods': {},
+        'feeRecipients': {},
+        'makers': {},
+        'caller': caller,
+        'orderCount': 0,
+        'fillCount': 0,
+        'updateCount': 0,
+    }
+
+def get_caller_address(raw_call):
+    # If it's a direct call, the caller is the EOA, otherwise we pick the
+    # the contract being called. This way we can group all calls that stem
+    # from the same top-level contract, not just the immediate caller.
+    if raw_call['toAddress'] == raw_call['calleeAddress']:
+        return raw_call['fromAddress']
+    return raw_call['toAddress']
+
+# Aggregates raw calls into per-caller records, in the parsed call data
+# format read by `data_utils.load_cluster_data()`.
+# Nothing is kept per call (or per order), so memory only grows with the
+# number of distinct callers and the addresses they interact with.
+# Addresses are interned in `addresses` (which several aggregators may
+# share), and records are keyed by address IDs until they're output. Callers
+# and senders come out as lowercase hex, fee recipients and makers checksummed,
+# like the decoder gives them.
+class CallerAggregator:
+    def __init__(self, decoder, since=None, until=None, addresses=None):
+        self.decoder = decoder
+        self.since = since
+        self.until = until
+        self.addresses = addresses if addresses is not None else AddressTable()
+        self.callers = {}
+        self.call_count = 0
+        self.order_count = 0
+        self._last_progress = 0
+
+    def add(self, raw_call):
+        timestamp = raw_call['timestamp']
+        if self.since is not None and timestamp < self.since:
+            return
+        if self.until is not None and timestamp > self.until:
+            return
+        # Decode before touching the caller's record, so callers whose calls
+        # are all skipped aren't output (with no methods).
+        try:
+            calls = self.decoder.extract_calls(raw_call['callData'], raw_call['callType'])
+        except (CallDecodeError, ValueError) as err:
+            print('Skipping call from %s: %s' % (raw_call['fromAddress'], err), file=sys.stderr)
+            return
+        intern = self.addresses.intern
+        caller = intern(get_caller_address(raw_call))
+        info = self.callers.get(caller)
+        if info is None:
+            info = self.callers[caller] = new_caller_record(caller)
+        _increment(info['senders'], intern(raw_call['fromAddress']))
+        methods = info['methods']
+        fee_recipients = info['feeRecipients']
+        makers = info['makers']
+        for call in calls:
+            for (maker, fee_recipient) in call.orders:
+                _increment(fee_recipients, intern(fee_recipient))
+                _increment(makers, intern(maker))
+            info['orderCount'] += len(call.orders)
+            info['fillCount'] += call.fills
+            info['updateCount'] += call.updates
+            _increment(methods, call.id)
+            self.order_count += len(call.orders)
+            self.call_count += 1
+
+    def add_all(self, lines, progress=False):
+        for line in lines:
+            if not line.strip():
+                continue
+            self.add(json.loads(line))
+            if progress and self.call_count // PROGRESS_INTERVAL != self._last_progress:
+                self._last_progress = self.call_count // PROGRESS_INTERVAL
+                self.print_progress()
+
+    def print_progress(self, end='\r'):
+        print(
+            '%d calls, %d orders, %d callers...' % (self.call_count, self.order_count, len(self.callers)),
+            end=end,
+            file=sys.stderr,
+        )
+
+    def records(self):
+        return (self._to_record(info) for info in self.callers.values())
+
+    def _to_record(self, info):
+        to_hex = self.addresses.to_hex
+        get_bytes = self.addresses.get_bytes
+        return {
+            **info,
+            'senders': { to_hex(a): n for (a, n) in info['senders'].items() },
+            'feeRecipients': { to_checksum_address(get_bytes(a)): n for (a, n) in info['feeRecipients'].items() },
+            'makers': { to_checksum_address(get_bytes(a)): n for (a, n) in info['makers'].items() },
+            'caller': to_hex(info['caller']),
+        }
+
+def _increment(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+# Add the counts of one caller record into another (for the same caller).
+# New keys are appended, so merging partial records in file order keeps the
+# keys in the order they were first seen. Compact records (see `sketches.py`)
+# can only be merged if they hold sketches.
+def merge_record(record, other):
+    if is_compact_record(record) or is_compact_record(other):
+        if not (is_compact_record(record) and is_compact_record(other)):
+            raise ValueError('cannot merge full and compact records for %s' % record['caller'])
+        merge_compact_counts(record, other)
+        fields = ('methods',)
+    else:
+        fields = ('senders', 'methods', 'feeRecipients', 'makers')
+    for field in fields:
+        counts = record[field]
+        for (key, count) in other[field].items():
+            counts[key] = counts.get(key, 0) + count
+    for field in ('orderCount', 'fillCount', 'updateCount'):
+        record[field] += other[field]
+    return record
+
+# Split a file into (start, end) byte ranges. Each line belongs to the range
+# it starts in.
+def split_file_ranges(file, num_ranges):
+    size = os.path.getsize(file)
+    step = max(1, -(-size // max(1, num_ranges)))
+    return [ (start, min(start + step, size)) for start in range(0, size, step) ]
+
+def iter_range_lines(file, start, end):
+    with open(file, 'rb') as f:
+        pos = start
+        if start > 0:
+            # Skip the line that started in the previous range.
+            f.seek(start - 1)
+            pos += len(f.readline()) - 1
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+def get_caller_shard(caller, num_shards):
+    return zlib.crc32(caller.encode('utf-8')) % num_shards
+
+# State shared by the sharded parse workers.
+_shard_worker = None
+
+def _init_shard_worker(since, until, tmp_dir, num_shards):
+    global _shard_worker
+    _shard_worker = (CallDecoder(load_default_abi()), since, until, tmp_dir, num_shards)
+
+# Aggregate one byte range of the raw call file, then hash-partition its
+# callers into shard files. Each record is tagged with the position the
+# caller was first seen at in the range, so the merge can restore file order.
+def _aggregate_range(file, range_index, start, end):
+    decoder, since, until, tmp_dir, num_shards = _shard_worker
+    aggregator = CallerAggregator(decoder, since=since, until=until)
+    aggregator.add_all(iter_range_lines(file, start, end))
+    shards = [ [] for _ in range(num_shards) ]
+    for (pos, record) in enumerate(aggregator.records()):
+        shards[get_caller_shard(record['caller'], num_shards)].append((pos, record))
+    for (shard, items) in enumerate(shards):
+        with open(_get_range_shard_file(tmp_dir, range_index, shard), 'wb') as f:
+            pickle.dump(items, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return aggregator.call_count, aggregator.order_count, len(aggregator.callers)
+
+# Merge the partial records of one shard from every range, in range order,
+# and write them out sorted by where each caller was first seen in the file.
+def _merge_shard(shard, num_ranges):
+    _, _, _, tmp_dir, _ = _shard_worker
+    merged = {}
+    for range_index in range(num_ranges):
+        range_file = _get_range_shard_file(tmp_dir, range_index, shard)
+        with open(range_file, 'rb') as f:
+            items = pickle.load(f)
+        os.remove(range_file)
+        for (pos, record) in items:
+            existing = merged.get(record['caller'])
+            if existing is None:
+                merged[record['caller']] = ((range_index, pos), record)
+            else:
+                merge_record(existing[1], record)
+    with open(_get_merged_shard_file(tmp_dir, shard), 'wb') as f:
+        for item in sorted(merged.values(), key=lambda item: item[0]):
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(merged)
+
+def _get_range_shard_file(tmp_dir, range_index, shard):
+    return os.path.join(tmp_dir, 'range-%d-shard-%d.pickle' % (range_index, shard))
+
+def _get_merged_shard_file(tmp_dir, shard):
+    return os.path.join(tmp_dir, 'shard-%d.pickle' % shard)
+
+def _iter_pickled(file):
+    with open(file, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+# Parse a raw call file across `workers` processes, yielding the same records,
+# in the same order, as a single `CallerAggregator` would.
+# The file is split into byte ranges which are aggregated independently.
+# Callers are then hash-partitioned into `num_shards` shards, which are merged
+# in parallel, so no process ever holds every caller at once.
+def parse_sharded(file, workers, since=None, until=None, num_shards=None, ranges_per_worker=4, tmp_dir=None):
+    num_shards = num_shards or workers
+    ranges = split_file_ranges(file, workers * ranges_per_worker)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as shard_dir:
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_shard_worker,
+                initargs=(since, until, shard_dir, num_shards),
+            ) as executor:
+            futures = [
+                executor.submit(_aggregate_range, file, i, start, end)
+                for (i, (start, end)) in enumerate(ranges)
+            ]
+            call_count = 0
+            order_count = 0
+            for (i, future) in enumerate(as_completed(futures)):
+                calls, orders, _ = future.result()
+                call_count += calls
+                order_count += orders
+                print(
+                    '%d/%d ranges, %d calls, %d orders...' % (i + 1, len(ranges), call_count, order_count),
+                    end='\r',
+                    file=sys.stderr,
+                )
+            print(file=sys.stderr)
+            caller_count = sum(executor.map(
+                _merge_shard,
+                range(num_shards),
+                [ len(ranges) ] * num_shards,
+            ))
+        print('%d calls, %d orders, %d callers' % (call_count, order_count, caller_count), file=sys.stderr)
+        shard_files = [ _get_merged_shard_file(shard_dir, shard) for shard in range(num_shards) ]
+        for (_, record) in heapq.merge(*map(_iter_pickled, shard_files), key=lambda item: item[0]):
+            yield record
+
+def to_json(record, pretty=False):
+    if pretty:
+        return json.dumps(record, indent=2)
+    return json.dumps(record, separators=(',', ':'))
+
+# Write records as JSON lines, joined like `parse-call-data.js` does (no
+# trailing newline).
+def write_records(records, f, pretty=False):
+    for (i, record) in enumerate(records):
+        if i > 0:
+            f.write('\n')
+        f.write(to_json(record, pretty=pretty))
+
+# Compact each record, with exact distinct counts or sketches (`compact` is
+# 'exact' or 'sketch').
+def compact_records(records, compact, precision=DEFAULT_PRECISION):
+    precision = None if compact == 'exact' else precision
+    return (compact_record(record, precision) for record in records)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Parse raw exchange and forwarder calls into per-caller call data')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='output file (default: stdout)')
+    parser.add_argument('-s', '--since', dest='since', default=None, type=str, help='starting period (unix time, ISO date, or e.g. "1 month ago")')
+    parser.add_argument('-u', '--until', dest='until', default=None, type=str, help='ending period (unix time, ISO date, or e.g. "1 day ago")')
+    parser.add_argument('--pretty', dest='pretty', default=False, action='store_true', help='pretty print output')
+    parser.add_argument('--compact', dest='compact', default=None, choices=('exact', 'sketch'), help='replace address maps with exact distinct counts or mergeable sketches')
+    parser.add_argument('--precision', dest='precision', default=DEFAULT_PRECISION, type=int, help='sketch precision (log2 of the number of registers)')
+    parser.add_argument('-j', '--workers', dest='workers', default=1, type=int, help='number of worker processes')
+    parser.add_argument('--shards', dest='num_shards', default=None, type=int, help='number of caller shards to merge (default: one per worker)')
+    parser.add_argument('--tmp-dir', dest='tmp_dir', default=None, type=str, help='where to write intermediate shard files')
+    parser.add_argument(dest='raw_call_data_file', type=str, help='the raw call data file')
+    args = parser.parse_args()
+
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    if args.workers > 1:
+        records = parse_sharded(
+            args.raw_call_data_file,
+            args.workers,
+            since=since,
+            until=until,
+            num_shards=args.num_shards,
+            tmp_dir=args.tmp_dir,
+        )
+    else:
+        aggregator = CallerAggregator(CallDecoder(load_default_abi()), since=since, until=until)
+        with open(args.raw_call_data_file) as f:
+            aggregator.add_all(f, progress=True)
+        aggregator.print_progress(end='\n')
+        records = aggregator.records()
+    if args.compact:
+        records = compact_records(records, args.compact, args.precision)
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            write_records(records, f, pretty=args.pretty)
+    else:
+        write_records(records, sys.stdout, pretty=args.pretty)
+        print()
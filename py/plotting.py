@@ -0,0 +1,22 @@
+# The plotting stack (matplotlib, seaborn, and `visuals`) is slow to import and
+# needs a display to show anything, so scripts only import it through here,
+# and only when they actually plot.
+
+# Import pyplot and `visuals`. If `headless` is set, a non-interactive backend
+# is selected first, so plots can be saved without a display.
+def import_plotting(headless=False):
+    import matplotlib
+    if headless:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import visuals
+    return plt, visuals
+
+# Show the current figure, or save it to `file` (the format is taken from the
+# file extension, e.g., `.png` or `.svg`).
+def show_or_save(plt, file=None):
+    if file:
+        plt.savefig(file)
+        print('Saved plot to %s.' % file)
+    else:
+        plt.show()
@@ -1,11 +1,12 @@
 import argparse
+from batch_predict import predict_file
 from clustering_model import ClusteringModel
-from data_utils import FEATURES, load_cluster_data, to_features, to_weight, split_by_labels
-import json
-import math
-import matplotlib.pyplot as plt
-import numpy as np
-from visuals import plot_heatmap
+from data_utils import get_model_features, load_cluster_data
+import metrics
+import os
+from plotting import import_plotting, show_or_save
+from report import ClusterReport
+import sys
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Fit call data to a cluster model')
@@ -14,51 +15,86 @@ if __name__ == '__main__':
     parser.add_argument('--attenuate', dest='attenuate', default=0.5, type=float, help='attenuation factor for collapsed clusters')
     parser.add_argument('--brighten', dest='brighten', default=0.625, type=float, help='brightening factor for collapsed clusters')
     parser.add_argument('--linear', dest='linear_scale', default=False, action='store_true', help='draw bar plots in linear scale')
-    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='file to output cluster information to')
-    parser.add_argument(dest='call_data_file', type=str, help='the call data file')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='file to output cluster information to (JSON, or JSON lines if it ends in .jsonl)')
+    parser.add_argument('--no-plot', dest='plot', default=True, action='store_false', help='do not plot (or import the plotting libraries)')
+    parser.add_argument('--plot-file', dest='plot_file', default=None, type=str, help='save the plot to a (.png, .svg, ...) file instead of showing it')
+    parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false', help='do not read or write the parsed call data cache')
+    parser.add_argument('--batch', dest='batch', default=False, action='store_true', help='label the call data in chunks across worker processes, without loading it all at once (implies --no-plot)')
+    parser.add_argument('--chunk-size', dest='chunk_size', default=100000, type=int, help='rows per chunk in batch mode')
+    parser.add_argument('-j', '--workers', dest='workers', default=os.cpu_count(), type=int, help='number of worker processes in batch mode')
+    parser.add_argument('--labels', dest='labels_file', default=None, type=str, help='write each caller\'s label to this CSV file')
+    parser.add_argument('--tmp-dir', dest='tmp_dir', default=None, type=str, help='where to spool callers while writing the output (default: the system temp directory)')
+    parser.add_argument('--dedup', dest='dedup', default=False, action='store_true', help='label each distinct feature row only once')
+    parser.add_argument('--dedup-decimals', dest='dedup_decimals', default=None, type=int, help='with --dedup, also merge rows that are the same when rounded to this many decimal places')
+    parser.add_argument('--float32', dest='float32', default=False, action='store_true', help='predict on single precision features, to halve their memory')
+    metrics.add_arguments(parser)
+    parser.add_argument(dest='call_data_file', type=str, help='the call data file, or a day snapshot window (DIR@SINCE..UNTIL)')
     args = parser.parse_args()
+    if args.batch and args.plot_file:
+        parser.error('--plot-file cannot be used with --batch')
+    metrics.enable_from_args(args)
 
-    call_data = load_cluster_data(args.call_data_file)
+    if args.batch:
+        num_rows = predict_file(
+            args.model_file,
+            args.call_data_file,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            output_file=args.output_file,
+            labels_file=args.labels_file,
+            cache=args.use_cache,
+            tmp_dir=args.tmp_dir,
+            dedup=args.dedup,
+            dedup_decimals=args.dedup_decimals,
+            float32=args.float32,
+        )
+        print(f'Labeled {num_rows} call data entries.')
+        if args.labels_file:
+            print('Wrote caller labels to %s.' % args.labels_file)
+        if args.output_file:
+            print('Wrote cluster data to %s.' % args.output_file)
+        metrics.write_from_args(args)
+        sys.exit(0)
+
+    call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
     print(f'Loaded {len(call_data)} call data entries.')
 
-    features = np.array([ to_features(x) for x in call_data ])
-    weights = np.array([ to_weight(d) for d in call_data ]).reshape(-1, 1)
+    features = get_model_features(call_data, args.float32)
+    weights = call_data.weights
 
     model = ClusteringModel.load_from_file(args.model_file)
     labels = model.predict(
         features,
         weights=weights,
+        dedup=args.dedup,
+        dedup_decimals=args.dedup_decimals,
     )
 
-    call_features = frozenset(x for x in FEATURES if x.startswith('calls_to_'))
+    if args.output_file or args.labels_file:
+        with metrics.span('write_output'), ClusterReport(args.labels_file, tmp_dir=args.tmp_dir) as report:
+            report.add(call_data, labels)
+            if args.output_file:
+                report.write(args.output_file)
+        if args.labels_file:
+            print('Wrote caller labels to %s.' % args.labels_file)
     if args.output_file:
-        data = {
-            k: {
-                'callers': [ d['caller'] for d in calls ],
-                'calls': {
-                    method[9:]: sum(math.ceil(d[method] * d['total_calls']) if method in d else 0 for d in calls)
-                    for method in call_features
-                },
-                'total_fills': sum([ d['total_fills'] for d in calls ]),
-                'total_orders': sum([ d['total_orders'] for d in calls ]),
-            }
-            for (k, calls)
-            in split_by_labels(call_data, labels).items()
-        }
-        with open(args.output_file, 'wt') as f:
-            f.write(json.dumps(data))
         print('Wrote cluster data to %s.' % args.output_file)
 
-    plot_heatmap(
-        call_data,
-        labels,
-        draw_dendrogram=args.draw_dendrogram,
-        linear_scale=args.linear_scale,
-        attenuate=args.attenuate,
-        brighten=args.brighten,
-        title=args.call_data_file,
-        col_ordering=model.viz_column_ordering,
-        row_ordering=model.viz_row_ordering,
-    )
+    if args.plot:
+        with metrics.span('plot'):
+            plt, visuals = import_plotting(headless=args.plot_file is not None)
+            visuals.plot_heatmap(
+                call_data,
+                labels,
+                draw_dendrogram=args.draw_dendrogram,
+                linear_scale=args.linear_scale,
+                attenuate=args.attenuate,
+                brighten=args.brighten,
+                title=args.call_data_file,
+                col_ordering=model.viz_column_ordering,
+                row_ordering=model.viz_row_ordering,
+            )
 
-    plt.show()
+    metrics.write_from_args(args)
+    if args.plot:
+        show_or_save(plt, args.plot_file)
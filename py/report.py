@@ -0,0 +1,163 @@
+from addresses import ADDRESS_SIZE, iter_hex_addresses
+from data_utils import FEATURES, label_to_classs_name
+import json
+import numpy as np
+import os
+import tempfile
+
+CALL_FEATURES = [ x for x in FEATURES if x.startswith('calls_to_') ]
+# Columns summed per cluster: rounded up calls to each method, then fills and
+# orders.
+_NUM_TOTALS = len(CALL_FEATURES) + 2
+_CALL_FEATURE_INDICES = [ FEATURES.index(x) for x in CALL_FEATURES ]
+# Bytes of spooled callers read back at once.
+_SPOOL_READ_SIZE = ADDRESS_SIZE * 4096
+
+def is_jsonl_report(file):
+    return os.path.splitext(file)[1].lower() == '.jsonl'
+
+# Builds the `predict --output` cluster report from labeled call data, one
+# chunk at a time, in a single pass over the rows of each chunk.
+# Per-cluster totals are kept as running sums, and each cluster's callers
+# are spooled (as raw 20 byte addresses) to a temporary file until the report
+# is written, so memory stays flat no matter how many callers there are.
+# Addresses are only turned into hex as they're written out. Clusters are reported in
+# the order they're first seen, like `split_by_labels()`.
+# If `labels_file` is given, each caller's label is written to it (as CSV)
+# as chunks are added.
+class ClusterReport:
+    def __init__(self, labels_file=None, tmp_dir=None):
+        self._tmp_dir = tempfile.TemporaryDirectory(dir=tmp_dir)
+        self._labels_file = open(labels_file, 'w') if labels_file else None
+        if self._labels_file:
+            self._labels_file.write('caller,label,cluster\n')
+        self.labels = []
+        self._names = []
+        # Maps `label + 1` to its index in `labels` (or -1).
+        self._label_index = np.full(1, -1, dtype=np.int64)
+        self._callers_files = []
+        self._num_callers = np.zeros(0, dtype=np.int64)
+        self._totals = np.zeros((0, _NUM_TOTALS))
+        self.num_rows = 0
+
+    def _add_labels(self, labels):
+        unique_labels, first_idx = np.unique(labels, return_index=True)
+        max_label = int(unique_labels[-1])
+        if max_label + 2 > len(self._label_index):
+            self._label_index = np.concatenate([
+                self._label_index,
+                np.full(max_label + 2 - len(self._label_index), -1, dtype=np.int64),
+            ])
+        new_labels = [
+            int(label) for label in unique_labels[np.argsort(first_idx)]
+            if self._label_index[label + 1] == -1
+        ]
+        for label in new_labels:
+            self._label_index[label + 1] = len(self.labels)
+            self.labels.append(label)
+            self._names.append(label_to_classs_name(label))
+            self._callers_files.append(open(
+                os.path.join(self._tmp_dir.name, '%d.bin' % label),
+                'wb',
+            ))
+        if new_labels:
+            self._num_callers = np.concatenate([ self._num_callers, np.zeros(len(new_labels), dtype=np.int64) ])
+            self._totals = np.concatenate([ self._totals, np.zeros((len(new_labels), _NUM_TOTALS)) ])
+
+    def add(self, call_data, labels):
+        labels = np.asarray(labels)
+        if len(labels) == 0:
+            return
+        self._add_labels(labels)
+        idx = self._label_index[labels + 1]
+        # Group the rows by cluster (stably, so callers keep their input order
+        # within each cluster), then sum each group.
+        order = np.argsort(idx, kind='stable')
+        bounds = np.searchsorted(idx[order], np.arange(len(self.labels) + 1))
+        present = np.flatnonzero(np.diff(bounds))
+        totals = np.empty((len(labels), _NUM_TOTALS))
+        np.multiply(
+            call_data.features[order][:, _CALL_FEATURE_INDICES],
+            call_data.total_calls[order, np.newaxis],
+            out=totals[:, :-2],
+        )
+        np.ceil(totals[:, :-2], out=totals[:, :-2])
+        totals[:, -2] = call_data.total_fills[order]
+        totals[:, -1] = call_data.total_orders[order]
+        self._totals[present] += np.add.reduceat(totals, bounds[present], axis=0)
+        self._num_callers += np.diff(bounds)
+        callers = call_data.addresses.get_rows(call_data.caller_ids[order])
+        for i in present:
+            self._callers_files[i].write(callers[bounds[i]:bounds[i + 1]].tobytes())
+        if self._labels_file:
+            self._labels_file.writelines(
+                '%s,%d,%s\n' % (caller, self.labels[i], self._names[i])
+                for (caller, i) in zip(call_data.callers, idx.tolist())
+            )
+        self.num_rows += len(labels)
+
+    def _iter_callers(self, i):
+        self._callers_files[i].flush()
+        with open(self._callers_files[i].name, 'rb') as f:
+            for data in iter(lambda: f.read(_SPOOL_READ_SIZE), b''):
+                yield from iter_hex_addresses(data)
+
+    def _get_calls(self, i):
+        return {
+            method[9:]: int(self._totals[i, j])
+            for (j, method) in enumerate(CALL_FEATURES)
+        }
+
+    # Write the cluster report, streaming each cluster's callers from its
+    # spool. A `.jsonl` file gets one JSON object per cluster (with its name
+    # under `cluster`), anything else gets the same single JSON object as
+    # `split_by_labels()` based output, keyed by cluster name.
+    def write(self, file):
+        with open(file, 'wt') as f:
+            if is_jsonl_report(file):
+                self._write_jsonl(f)
+            else:
+                self._write_json(f)
+
+    def _write_json(self, f):
+        f.write('{')
+        for (i, name) in enumerate(self._names):
+            if i > 0:
+                f.write(', ')
+            f.write('%s: {"callers": [' % json.dumps(name))
+            for (j, caller) in enumerate(self._iter_callers(i)):
+                f.write((', %s' if j > 0 else '%s') % json.dumps(caller))
+            f.write('], "calls": %s, "total_fills": %d, "total_orders": %d}' % (
+                json.dumps(self._get_calls(i)),
+                self._totals[i, -2],
+                self._totals[i, -1],
+            ))
+        f.write('}')
+
+    def _write_jsonl(self, f):
+        for (i, name) in enumerate(self._names):
+            f.write('{"cluster": %s, "label": %d, "num_callers": %d, "calls": %s, "total_fills": %d, "total_orders": %d, "callers": [' % (
+                json.dumps(name),
+                self.labels[i],
+                self._num_callers[i],
+                json.dumps(self._get_calls(i)),
+                self._totals[i, -2],
+                self._totals[i, -1],
+            ))
+            for (j, caller) in enumerate(self._iter_callers(i)):
+                f.write((', %s' if j > 0 else '%s') % json.dumps(caller))
+            f.write(']}\n')
+
+    def close(self):
+        for f in self._callers_files:
+            f.close()
+        if self._labels_file:
+            self._labels_file.close()
+        self._tmp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
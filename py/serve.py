@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+from clustering_model import ClusteringModel
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from data_utils import CallData, label_to_classs_name
+import json
+import time
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Latency and throughput counters for the server.
+class ServerStats:
+    def __init__(self, window=4096):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.callers = 0
+        self.batches = 0
+        self.batched_callers = 0
+        self.predict_seconds = 0.
+        self.max_batch_size = 0
+        # Latencies (in seconds) of the most recent requests.
+        self.latencies = deque(maxlen=window)
+
+    def to_dict(self):
+        uptime = time.time() - self.started
+        latencies = sorted(self.latencies)
+        percentile = lambda p: \
+            latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3 if latencies else 0
+        return {
+            'uptime_seconds': uptime,
+            'requests': self.requests,
+            'errors': self.errors,
+            'callers': self.callers,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_callers / self.batches if self.batches else 0,
+            'max_batch_size': self.max_batch_size,
+            'callers_per_second': self.callers / uptime if uptime > 0 else 0,
+            'predict_seconds': self.predict_seconds,
+            'latency_ms': {
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+                'max': latencies[-1] * 1e3 if latencies else 0,
+            },
+        }
+
+# Serves predictions from a model held in memory. Concurrent requests are
+# collected into micro-batches so each batch is predicted in one call.
+class PredictionServer:
+    def __init__(self, model, max_batch_size=4096, max_wait=0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = ServerStats()
+        self._queue = None
+        # Prediction runs off the event loop, one batch at a time.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        asyncio.ensure_future(self._run_batches())
+
+    # Label a list of caller aggregates, in the parse step's schema.
+    async def predict(self, records):
+        if not records:
+            return []
+        call_data = CallData.from_records(records)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((call_data, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [ await self._queue.get() ]
+            size = len(pending[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(item)
+                size += len(item[0])
+            try:
+                labels = await loop.run_in_executor(
+                    self._executor,
+                    self._predict_batch,
+                    CallData.concatenate([ call_data for (call_data, _) in pending ]),
+                )
+            except Exception as err:
+                if len(pending) == 1:
+                    _set_exception(pending[0][1], err)
+                    continue
+                # Retry each request on its own, so only the bad ones fail.
+                for (call_data, future) in pending:
+                    try:
+                        labels = await loop.run_in_executor(self._executor, self._predict_batch, call_data)
+                    except Exception as err:
+                        _set_exception(future, err)
+                    else:
+                        _set_results(future, call_data, labels)
+                continue
+            i = 0
+            for (call_data, future) in pending:
+                _set_results(future, call_data, labels[i:i + len(call_data)])
+                i += len(call_data)
+
+    def _predict_batch(self, call_data):
+        t = time.perf_counter()
+        labels = self.model.predict(
+            call_data.features,
+            weights=call_data.weights.reshape(-1, 1),
+        )
+        self.stats.predict_seconds += time.perf_counter() - t
+        self.stats.batches += 1
+        self.stats.batched_callers += len(call_data)
+        self.stats.max_batch_size = max(self.stats.max_batch_size, len(call_data))
+        return labels
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await _read_http_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                t = time.perf_counter()
+                status, response = await self._route(method, path, body)
+                if path == '/predict':
+                    self.stats.requests += 1
+                    self.stats.latencies.append(time.perf_counter() - t)
+                    if status != 200:
+                        self.stats.errors += 1
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                _write_http_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as err:
+            _write_http_response(writer, 400, { 'error': str(err) }, False)
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if path == '/metrics':
+            return 200, self.stats.to_dict()
+        if path == '/health':
+            return 200, { 'ok': True }
+        if path != '/predict':
+            return 404, { 'error': 'not found' }
+        if method != 'POST':
+            return 405, { 'error': 'use POST' }
+        try:
+            records = json.loads(body.decode('utf-8'))
+            is_single = isinstance(records, dict)
+            results = await self.predict([ records ] if is_single else records)
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            return 400, { 'error': 'invalid caller data: %r' % err }
+        except Exception as err:
+            return 500, { 'error': str(err) }
+        self.stats.callers += len(results)
+        return 200, results[0] if is_single else results
+
+def _set_results(future, call_data, labels):
+    if not future.done():
+        future.set_result([
+            {
+                'caller': str(caller),
+                'label': int(label),
+                'class_name': label_to_classs_name(label),
+            }
+            for (caller, label) in zip(call_data.callers, labels)
+        ])
+
+def _set_exception(future, err):
+    if not future.done():
+        future.set_exception(err)
+
+async def _read_http_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise ValueError('malformed request line')
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    size = int(headers.get('content-length', 0))
+    if size > MAX_BODY_SIZE:
+        raise ValueError('request body too large')
+    body = await reader.readexactly(size) if size else b''
+    return method, path.split('?')[0], headers, body
+
+def _write_http_response(writer, status, data, keep_alive):
+    body = json.dumps(data).encode('utf-8')
+    writer.write((
+        'HTTP/1.1 %d %s\r\n'
+        'Content-Type: application/json\r\n'
+        'Content-Length: %d\r\n'
+        'Connection: %s\r\n'
+        '\r\n'
+    ).encode('latin-1') % (
+        status,
+        HTTP_REASONS[status].encode('latin-1'),
+        len(body),
+        b'keep-alive' if keep_alive else b'close',
+    ) + body)
+
+async def serve(server, host=None, port=None, unix_socket=None):
+    await server.start()
+    if unix_socket:
+        listener = await asyncio.start_unix_server(server.handle_connection, path=unix_socket)
+        print('Listening on %s.' % unix_socket)
+    else:
+        listener = await asyncio.start_server(server.handle_connection, host=host, port=port)
+        print('Listening on http://%s:%d.' % (host, port))
+    async with listener:
+        await listener.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Serve cluster predictions over HTTP')
+    parser.add_argument('--model', dest='model_file', default=None, type=str, required=True, help='cluster model file')
+    parser.add_argument('--host', dest='host', default='127.0.0.1', type=str, help='address to listen on')
+    parser.add_argument('-p', '--port', dest='port', default=8080, type=int, help='port to listen on')
+    parser.add_argument('--unix', dest='unix_socket', default=None, type=str, help='listen on a unix socket at this path instead')
+    parser.add_argument('--max-batch-size', dest='max_batch_size', default=4096, type=int, help='maximum callers to predict in one batch')
+    parser.add_argument('--max-wait-ms', dest='max_wait_ms', default=5, type=float, help='maximum time to wait for a batch to fill up')
+    args = parser.parse_args()
+
+    model = ClusteringModel.load_from_file(args.model_file)
+    print('Loaded model from %s.' % args.model_file)
+    server = PredictionServer(
+        model,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1e3,
+    )
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
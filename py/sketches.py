@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import math
+import numpy as np
+import zlib
+
+DEFAULT_PRECISION = 12
+# Compact records replace each address map of a full caller record with a
+# distinct count, under these keys. Senders exclude the caller itself, like
+# `parse_cluster_data_item()` counts them.
+COMPACT_FIELDS = {
+    'senders': 'uniqueSenders',
+    'feeRecipients': 'uniqueFeeRecipients',
+    'makers': 'uniqueMakers',
+}
+
+def hash_value(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+# A mergeable distinct counter (HyperLogLog, with 2^precision registers).
+# Small sets are kept "sparse", as the exact set of 64-bit value hashes, so
+# they're counted exactly (barring hash collisions) and take up little room.
+# Once a set outgrows the sparse limit it switches to dense registers, whose
+# relative standard error is about 1.04 / sqrt(2^precision), or 1.6% at the
+# default precision.
+class DistinctSketch:
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.hashes = set()
+        self.registers = None
+
+    @property
+    def num_registers(self):
+        return 1 << self.precision
+
+    @property
+    def sparse_limit(self):
+        return self.num_registers // 16
+
+    @property
+    def is_sparse(self):
+        return self.registers is None
+
+    @staticmethod
+    def from_values(values, precision=DEFAULT_PRECISION):
+        sketch = DistinctSketch(precision)
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def add(self, value):
+        self.add_hash(hash_value(value))
+
+    def add_hash(self, h):
+        if self.registers is None:
+            self.hashes.add(h)
+            if len(self.hashes) > self.sparse_limit:
+                self._densify()
+            return
+        bits = 64 - self.precision
+        i = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def _densify(self):
+        self.registers = np.zeros(self.num_registers, dtype=np.uint8)
+        hashes = self.hashes
+        self.hashes = set()
+        for h in hashes:
+            self.add_hash(h)
+
+    # Merge another sketch (of the same precision) into this one.
+    def update(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches of different precisions (%d and %d)' % (
+                self.precision,
+                other.precision,
+            ))
+        if other.registers is None:
+            for h in other.hashes:
+                self.add_hash(h)
+            return self
+        if self.registers is None:
+            self._densify()
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        if self.registers is None:
+            return len(self.hashes)
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1., -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros > 0:
+            # Linear counting, for small cardinalities.
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    # Sketches are stored as 's<precision>:<hashes>' or 'd<precision>:<registers>',
+    # with the sorted hashes (8 bytes each) or the zlib'd registers in base64.
+    def to_string(self):
+        if self.registers is None:
+            payload = b''.join(h.to_bytes(8, 'big') for h in sorted(self.hashes))
+            return 's%d:%s' % (self.precision, base64.b64encode(payload).decode('ascii'))
+        payload = zlib.compress(self.registers.tobytes())
+        return 'd%d:%s' % (self.precision, base64.b64encode(payload).decode('ascii'))
+
+    @staticmethod
+    def from_string(text):
+        kind, _, payload = text.partition(':')
+        sketch = DistinctSketch(int(kind[1:]))
+        payload = base64.b64decode(payload)
+        if kind[0] == 's':
+            sketch.hashes = {
+                int.from_bytes(payload[i:i + 8], 'big') for i in range(0, len(payload), 8)
+            }
+        elif kind[0] == 'd':
+            sketch.registers = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).copy()
+            if len(sketch.registers) != sketch.num_registers:
+                raise ValueError('malformed sketch')
+        else:
+            raise ValueError('unknown sketch kind: %r' % kind)
+        return sketch
+
+def is_compact_record(record):
+    return 'uniqueSenders' in record
+
+# Replace the address maps in a full caller record with exact distinct counts
+# (if `precision` is None), which are smallest but can't be merged, or with
+# `DistinctSketch`es, which can.
+def compact_record(record, precision=DEFAULT_PRECISION):
+    caller = record['caller']
+    compact = {
+        k: v for (k, v) in record.items() if k not in COMPACT_FIELDS
+    }
+    for (field, compact_field) in COMPACT_FIELDS.items():
+        values = record[field]
+        if field == 'senders':
+            values = [ a for a in values if a != caller ]
+        if precision is None:
+            compact[compact_field] = len(values)
+        else:
+            compact[compact_field] = DistinctSketch.from_values(values, precision).to_string()
+    return compact
+
+# Merge the distinct counts of two compact records.
+def merge_compact_counts(record, other):
+    for compact_field in COMPACT_FIELDS.values():
+        a = record[compact_field]
+        b = other[compact_field]
+        if not isinstance(a, str) or not isinstance(b, str):
+            raise ValueError('exact distinct counts cannot be merged, use sketches')
+        record[compact_field] = \
+            DistinctSketch.from_string(a).update(DistinctSketch.from_string(b)).to_string()
+    return record
+
+# The (senders, fee recipients, makers) distinct counts of a full or compact
+# caller record.
+def get_unique_counts(record):
+    if not is_compact_record(record):
+        caller = record['caller']
+        return (
+            sum(1 for a in record['senders'] if a != caller),
+            len(record['feeRecipients']),
+            len(record['makers']),
+        )
+    return tuple(
+        v if isinstance(v, int) else DistinctSketch.from_string(v).count()
+        for v in (record[f] for f in COMPACT_FIELDS.values())
+    )
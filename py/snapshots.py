@@ -0,0 +1,167 @@
+from addresses import AddressTable
+import argparse
+from call_decoder import CallDecoder, load_default_abi
+from datetime import datetime, timezone
+import json
+import os
+from parse_call_data import CallerAggregator, compact_records, merge_record, parse_time, write_records
+import re
+from sketches import DEFAULT_PRECISION
+import sys
+
+# Day snapshots are parsed call data files (one caller record per line, like
+# the parse step outputs) holding only the calls made on one (UTC) day, named
+# `YYYY-MM-DD.json`. Since caller records are just counts, any window of days
+# can be built by merging the snapshots in it, without touching the raw calls.
+DAY_FORMAT = '%Y-%m-%d'
+_DAY_FILE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})\.json$')
+# `DIR@SINCE..UNTIL`, where either end may be left out.
+_WINDOW_SPEC_PATTERN = re.compile(r'^(.+)@(.*)\.\.(.*)$')
+
+def to_day(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime(DAY_FORMAT)
+
+def get_day_file(snapshot_dir, day):
+    return os.path.join(snapshot_dir, day + '.json')
+
+def list_days(snapshot_dir):
+    days = []
+    for file in os.listdir(snapshot_dir):
+        m = _DAY_FILE_PATTERN.match(file)
+        if m:
+            days.append(m.group(1))
+    return sorted(days)
+
+# Aggregate raw calls into one `CallerAggregator` per day. The days share one
+# address table.
+def aggregate_days(lines, decoder, since=None, until=None):
+    addresses = AddressTable()
+    aggregators = {}
+    call_count = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        raw_call = json.loads(line)
+        day = to_day(raw_call['timestamp'])
+        aggregator = aggregators.get(day)
+        if aggregator is None:
+            aggregator = aggregators[day] = CallerAggregator(decoder, since=since, until=until, addresses=addresses)
+        aggregator.add(raw_call)
+        call_count += 1
+        if call_count % 100000 == 0:
+            print('%d raw calls, %d days...' % (call_count, len(aggregators)), end='\r', file=sys.stderr)
+    return aggregators
+
+# Write (or replace) the day snapshots for every day in a raw call file.
+# Days already in `snapshot_dir` are replaced, unless `skip_existing` is set,
+# so the raw file should cover whole days. If `precision` is set, snapshots
+# are written as compact records with distinct count sketches.
+def write_day_snapshots(raw_call_data_file, snapshot_dir, since=None, until=None, skip_existing=False, precision=None):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    with open(raw_call_data_file) as f:
+        aggregators = aggregate_days(f, CallDecoder(load_default_abi()), since=since, until=until)
+    written = []
+    for (day, aggregator) in sorted(aggregators.items()):
+        day_file = get_day_file(snapshot_dir, day)
+        if not aggregator.callers or (skip_existing and os.path.exists(day_file)):
+            continue
+        records = aggregator.records()
+        if precision is not None:
+            records = compact_records(records, 'sketch', precision)
+        with open(day_file + '.tmp', 'w') as f:
+            write_records(records, f)
+        os.replace(day_file + '.tmp', day_file)
+        written.append(day)
+    return written
+
+def is_window_spec(spec):
+    if os.path.isfile(spec):
+        return False
+    return _WINDOW_SPEC_PATTERN.match(spec) is not None or os.path.isdir(spec)
+
+# Parse a `DIR@SINCE..UNTIL` window spec (or just `DIR`, for every day) into
+# the snapshot directory and the first and last days (inclusive) of the window.
+# SINCE and UNTIL take the same forms as the parse step's `--since/--until`,
+# except that `YYYY-MM-DD` is taken as that (UTC) day, not local midnight.
+def parse_window_spec(spec):
+    m = _WINDOW_SPEC_PATTERN.match(spec)
+    if not m:
+        return spec, None, None
+    snapshot_dir, since, until = m.groups()
+    return (
+        snapshot_dir,
+        _parse_window_day(since) if since else None,
+        _parse_window_day(until) if until else None,
+    )
+
+def _parse_window_day(text):
+    try:
+        return datetime.strptime(text.strip(), DAY_FORMAT).strftime(DAY_FORMAT)
+    except ValueError:
+        return to_day(parse_time(text))
+
+def get_window_days(snapshot_dir, first_day=None, last_day=None):
+    return [
+        day for day in list_days(snapshot_dir)
+        if (first_day is None or day >= first_day) and (last_day is None or day <= last_day)
+    ]
+
+# Merge the day snapshots in a window into caller records, in the order
+# callers were first seen.
+def iter_window_records(spec):
+    snapshot_dir, first_day, last_day = parse_window_spec(spec)
+    if not os.path.isdir(snapshot_dir):
+        raise ValueError('no snapshot directory at %s' % snapshot_dir)
+    records = {}
+    for day in get_window_days(snapshot_dir, first_day, last_day):
+        with open(get_day_file(snapshot_dir, day)) as f:
+            for line in f:
+                record = json.loads(line)
+                existing = records.get(record['caller'])
+                if existing is None:
+                    records[record['caller']] = record
+                else:
+                    merge_record(existing, record)
+    return iter(records.values())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Maintain per-day caller snapshots and build windows from them')
+    commands = parser.add_subparsers(dest='command')
+    add_parser = commands.add_parser('add', help='add (or replace) day snapshots from a raw call data file')
+    add_parser.add_argument('-d', '--dir', dest='snapshot_dir', required=True, type=str, help='snapshot directory')
+    add_parser.add_argument('-s', '--since', dest='since', default=None, type=str, help='ignore calls before this time')
+    add_parser.add_argument('-u', '--until', dest='until', default=None, type=str, help='ignore calls after this time')
+    add_parser.add_argument('--skip-existing', dest='skip_existing', default=False, action='store_true', help='keep days that already have a snapshot')
+    add_parser.add_argument('--compact', dest='compact', default=False, action='store_true', help='write compact records, with distinct count sketches')
+    add_parser.add_argument('--precision', dest='precision', default=DEFAULT_PRECISION, type=int, help='sketch precision (log2 of the number of registers)')
+    add_parser.add_argument(dest='raw_call_data_file', type=str, help='the raw call data file')
+    build_parser = commands.add_parser('build', help='merge a window of day snapshots into a parsed call data file')
+    build_parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='output file (default: stdout)')
+    build_parser.add_argument(dest='window', type=str, help='window spec, as DIR@SINCE..UNTIL')
+    list_parser = commands.add_parser('list', help='list the days in a snapshot directory')
+    list_parser.add_argument(dest='snapshot_dir', type=str, help='snapshot directory')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        days = write_day_snapshots(
+            args.raw_call_data_file,
+            args.snapshot_dir,
+            since=parse_time(args.since) if args.since else None,
+            until=parse_time(args.until) if args.until else None,
+            skip_existing=args.skip_existing,
+            precision=args.precision if args.compact else None,
+        )
+        print('Wrote %d day snapshots to %s.' % (len(days), args.snapshot_dir), file=sys.stderr)
+    elif args.command == 'build':
+        records = iter_window_records(args.window)
+        if args.output_file:
+            with open(args.output_file, 'w') as f:
+                write_records(records, f)
+        else:
+            write_records(records, sys.stdout)
+            print()
+    elif args.command == 'list':
+        for day in list_days(args.snapshot_dir):
+            print(day)
+    else:
+        parser.print_help()
@@ -0,0 +1,140 @@
+import argparse
+from call_decoder import is_fill_method
+import numpy as np
+from parse_call_data import new_caller_record, to_json
+import sys
+
+# Rough kinds of 0x callers, with the share of callers they make up, the
+# relative frequency of the methods they call, and the (log-normal) spread of
+# how many calls, orders per call, extra senders, makers and fee recipients
+# each has. `contract` callers are called through by other senders, the rest
+# are EOAs sending their own transactions.
+ARCHETYPES = {
+    'retail': {
+        'share': 0.70,
+        'methods': { 'marketBuyOrdersWithEth': 5, 'fillOrder': 3, 'marketSellOrdersWithEth': 1, 'fillOrKillOrder': 1, 'cancelOrder': 1 },
+        'calls': (0.3, 0.8),
+        'orders_per_call': (0.3, 0.5),
+        'senders': None,
+        'makers': (0.5, 0.8),
+        'fee_recipients': (0.0, 0.4),
+    },
+    'aggregator': {
+        'share': 0.10,
+        'methods': { 'marketBuyOrders': 3, 'marketSellOrders': 3, 'marketBuyOrdersNoThrow': 2, 'marketSellOrdersNoThrow': 2, 'batchFillOrders': 1 },
+        'calls': (3.0, 1.5),
+        'orders_per_call': (1.0, 0.7),
+        'senders': (3.0, 1.5),
+        'makers': (2.5, 1.2),
+        'fee_recipients': (1.0, 0.8),
+        'contract': True,
+    },
+    'bot': {
+        'share': 0.10,
+        'methods': { 'fillOrKillOrder': 4, 'batchFillOrKillOrders': 2, 'fillOrderNoThrow': 2, 'batchFillOrdersNoThrow': 2, 'matchOrders': 1 },
+        'calls': (4.5, 1.5),
+        'orders_per_call': (0.7, 0.6),
+        'senders': (0.0, 0.5),
+        'makers': (3.0, 1.5),
+        'fee_recipients': (0.7, 0.7),
+        'contract': True,
+    },
+    'market_maker': {
+        'share': 0.05,
+        'methods': { 'cancelOrder': 4, 'batchCancelOrders': 3, 'cancelOrdersUpTo': 2, 'preSign': 1, 'fillOrder': 1 },
+        'calls': (4.0, 1.5),
+        'orders_per_call': (0.8, 0.6),
+        'senders': None,
+        'makers': (0.0, 0.3),
+        'fee_recipients': (0.5, 0.6),
+    },
+    'relayer': {
+        'share': 0.05,
+        'methods': { 'tx_fillOrder': 4, 'tx_batchFillOrders': 2, 'tx_fillOrKillOrder': 2, 'tx_cancelOrder': 1, 'executeTransaction': 4 },
+        'calls': (5.0, 1.5),
+        'orders_per_call': (0.5, 0.5),
+        'senders': (5.0, 1.5),
+        'makers': (4.0, 1.5),
+        'fee_recipients': (0.0, 0.3),
+        'contract': True,
+    },
+}
+# Caps on sampled counts, to keep the biggest callers (and generation time)
+# in check.
+MAX_CALLS = 1000000
+MAX_ADDRESSES = 20000
+ADDRESS_POOL_SIZE = 1 << 20
+
+def _to_address(i):
+    return '0x%040x' % i
+
+# Generate `num_callers` parsed caller records (in the schema the parse step
+# writes), deterministically from `seed`.
+def generate_callers(num_callers, seed=1337):
+    rng = np.random.default_rng(seed)
+    names = list(ARCHETYPES)
+    shares = np.array([ ARCHETYPES[n]['share'] for n in names ])
+    archetypes = rng.choice(len(names), size=num_callers, p=shares / shares.sum())
+    # Makers, fee recipients and senders come from a shared pool of
+    # addresses, with a heavy tail of popular ones.
+    pool_offset = 1 << 159
+    methods = {
+        n: (list(a['methods']), np.array(list(a['methods'].values()), dtype=np.float64))
+        for (n, a) in ARCHETYPES.items()
+    }
+    for methods_and_weights in methods.values():
+        methods_and_weights[1][:] /= methods_and_weights[1].sum()
+    lognormal_int = lambda spread, cap: \
+        int(min(cap, max(1, rng.lognormal(*spread)))) if spread is not None else 0
+    pick_addresses = lambda count: [
+        _to_address(pool_offset + int(i))
+        for i in np.unique(rng.zipf(1.3, size=count) % ADDRESS_POOL_SIZE)
+    ]
+    for i in range(num_callers):
+        name = names[archetypes[i]]
+        archetype = ARCHETYPES[name]
+        caller = _to_address(int(rng.integers(1 << 60)) << 96 | i)
+        record = new_caller_record(caller)
+        num_calls = lognormal_int(archetype['calls'], MAX_CALLS)
+        method_names, method_weights = methods[name]
+        for (method, count) in zip(method_names, rng.multinomial(num_calls, method_weights)):
+            if count == 0:
+                continue
+            record['methods'][method] = int(count)
+            if method == 'executeTransaction':
+                continue
+            num_orders = int(count) * lognormal_int(archetype['orders_per_call'], MAX_ADDRESSES)
+            record['orderCount'] += num_orders
+            record['updateCount'] += num_orders
+            if is_fill_method(method):
+                record['fillCount'] += num_orders
+        if archetype.get('contract'):
+            senders = pick_addresses(lognormal_int(archetype['senders'], MAX_ADDRESSES))
+            record['senders'] = { s: int(c) for (s, c) in zip(senders, rng.integers(1, 10, size=len(senders))) }
+        else:
+            record['senders'] = { caller: num_calls }
+        if record['orderCount']:
+            record['makers'] = { m: 1 for m in pick_addresses(lognormal_int(archetype['makers'], MAX_ADDRESSES)) }
+            record['feeRecipients'] = {
+                f: 1 for f in pick_addresses(lognormal_int(archetype['fee_recipients'], MAX_ADDRESSES))
+            }
+        yield record
+
+def write_callers(file, num_callers, seed=1337):
+    with open(file, 'w') as f:
+        for (i, record) in enumerate(generate_callers(num_callers, seed)):
+            if i > 0:
+                f.write('\n')
+            f.write(to_json(record))
+            if (i + 1) % 100000 == 0:
+                print('%d/%d callers...' % (i + 1, num_callers), end='\r', file=sys.stderr)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Generate synthetic parsed call data')
+    parser.add_argument('-n', '--callers', dest='num_callers', default=100000, type=int, help='number of callers to generate')
+    parser.add_argument('--seed', dest='seed', default=1337, type=int, help='random seed')
+    parser.add_argument('-o', '--output', dest='output_file', required=True, type=str, help='output file')
+    args = parser.parse_args()
+
+    write_callers(args.output_file, args.num_callers, args.seed)
+    print('Wrote %d synthetic callers to %s.' % (args.num_callers, args.output_file), file=sys.stderr)
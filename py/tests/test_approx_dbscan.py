@@ -0,0 +1,37 @@
+import approx_dbscan
+from clustering_model import ClusteringModel
+from data_utils import CallData
+import numpy as np
+import pytest
+from synth_data import generate_callers
+
+def get_synth_data(num_callers):
+    call_data = CallData.from_records(generate_callers(num_callers, seed=1337))
+    return call_data.features, call_data.weights
+
+def test_coarsened_fit_labels_match_predict(tmp_path):
+    features, weights = get_synth_data(5000)
+    model = ClusteringModel()
+    fit_labels = model.fit_outliers(
+        features,
+        weights,
+        eps=0.15,
+        min_samples=100,
+        engine='grid',
+        rho=0.1,
+        max_cells=1500,
+    )
+    # The grid had to be coarsened (to rho = 0.8) to fit in `max_cells`.
+    assert model.dbscan_model.rho == pytest.approx(0.8)
+    is_inlier = fit_labels != -1
+    assert 0 < np.count_nonzero(is_inlier) < len(features)
+    model.kmeans_model = ClusteringModel.fit_kmeans(features[is_inlier], weights[is_inlier], 4, n_init=1)
+    model.save_to_file(str(tmp_path / 'model.bin'))
+    loaded = ClusteringModel.load_from_file(str(tmp_path / 'model.bin'))
+    predict_labels = ClusteringModel.dbscan_predict(loaded.dbscan_model, features)
+    assert np.array_equal(fit_labels, predict_labels)
+
+def test_grid_is_not_coarsened_past_eps():
+    features, weights = get_synth_data(5000)
+    with pytest.raises(ValueError, match='max_cells'):
+        approx_dbscan.fit_grid_dbscan(features, weights, 0.15, 100, rho=0.1, max_cells=1000)
@@ -0,0 +1,58 @@
+from clustering_model import ClusteringModel
+import metrics
+import numpy as np
+import sklearn.cluster
+
+def test_streaming_fit_steps_once_per_batch(monkeypatch):
+    rng = np.random.RandomState(1337)
+    chunks = [ (rng.random_sample((1000, 3)), np.ones(1000)) for _ in range(2) ]
+    batch_sizes = []
+    partial_fit = sklearn.cluster.MiniBatchKMeans.partial_fit
+    def record_partial_fit(self, features, *args, **kwargs):
+        batch_sizes.append(len(features))
+        return partial_fit(self, features, *args, **kwargs)
+    monkeypatch.setattr(sklearn.cluster.MiniBatchKMeans, 'partial_fit', record_partial_fit)
+    model = ClusteringModel()
+    model.fit_streaming(
+        chunks[0][0],
+        chunks[0][1],
+        0.5,
+        lambda: iter(chunks),
+        num_clusters=4,
+        # Every row is a core.
+        eps=1.,
+        min_samples=1,
+        batch_size=300,
+    )
+    # Leftover inliers carry over into the next chunk's batches.
+    assert batch_sizes == [ 300 ] * 6 + [ 200 ]
+
+def test_predict_all_outliers_with_sklearn_kmeans():
+    rng = np.random.RandomState(1337)
+    features = rng.random_sample((200, 3))
+    model = ClusteringModel()
+    model.fit(features, num_clusters=4, eps=1., min_samples=1, n_init=1)
+    assert isinstance(model.kmeans_model, sklearn.cluster.KMeans)
+    labels = model.predict(features[:2] + 10)
+    assert labels.tolist() == [ -1, -1 ]
+
+def test_dedup_predict_counts_every_row():
+    rng = np.random.RandomState(1337)
+    features = rng.random_sample((200, 3))
+    model = ClusteringModel()
+    model.fit(features, num_clusters=4, eps=0.1, min_samples=3, n_init=1)
+    # Every row appears 3 times, and a few are far off outliers.
+    features = np.concatenate([ features, features[:10] + 10 ])
+    features = np.repeat(features, 3, axis=0)
+    counters = []
+    for dedup in (False, True):
+        metrics.enable()
+        try:
+            labels = model.predict(features, dedup=dedup)
+            report = metrics.get_report()['counters']
+            counters.append({ name: report[name] for name in ('predict_rows', 'predict_outliers') })
+        finally:
+            metrics.disable()
+    assert counters[0] == counters[1]
+    assert counters[1]['predict_rows'] == len(features)
+    assert counters[1]['predict_outliers'] == np.count_nonzero(labels == -1) >= 30
@@ -0,0 +1,35 @@
+from call_decoder import CallDecoder, load_default_abi
+from data_utils import load_cluster_data
+from parse_call_data import CallerAggregator, write_records
+
+EXCHANGE = '0x4f833a24e1f95d70f028921e27040ca56e09ab0b'
+CALLER = '0x1119ba308d16c2742897d3720593c11ac5aa385e'
+SKIPPED_CALLER = '0x6fad79364406c053f895fc553fd3be98261f40df'
+# `cancelOrdersUpTo(1)`.
+CANCEL_CALL_DATA = '0x4f9559b1' + '%064x' % 1
+
+def raw_call(sender, call_data):
+    return {
+        'timestamp': 1560000000,
+        'fromAddress': sender,
+        'toAddress': EXCHANGE,
+        'calleeAddress': EXCHANGE,
+        'callData': call_data,
+        'callType': 'call',
+    }
+
+def test_skipped_calls_leave_no_record(tmp_path):
+    aggregator = CallerAggregator(CallDecoder(load_default_abi()))
+    aggregator.add(raw_call(CALLER, CANCEL_CALL_DATA))
+    # Unknown selector, then bad hex.
+    aggregator.add(raw_call(SKIPPED_CALLER, '0xdeadbeef'))
+    aggregator.add(raw_call(SKIPPED_CALLER, '0x4f9559b1zz'))
+    records = list(aggregator.records())
+    assert [ r['caller'] for r in records ] == [ CALLER ]
+    assert records[0]['methods'] == { 'cancelOrdersUpTo': 1 }
+
+    file = str(tmp_path / 'parsed.json')
+    with open(file, 'w') as f:
+        write_records(records, f)
+    call_data = load_cluster_data(file, cache=False)
+    assert call_data.callers == [ CALLER ]
@@ -0,0 +1,42 @@
+import asyncio
+import numpy as np
+import pytest
+from serve import PredictionServer
+
+BAD_ORDER_COUNT = 999
+
+# Fails any batch with a caller that has `BAD_ORDER_COUNT` orders.
+class FailingModel:
+    def predict(self, features, weights=None):
+        if np.any(weights == BAD_ORDER_COUNT):
+            raise ValueError('bad caller')
+        return np.zeros(len(features), dtype=np.int32)
+
+def record(i, order_count=1):
+    return {
+        'senders': {},
+        'methods': { 'fillOrder': 1 },
+        'feeRecipients': {},
+        'makers': {},
+        'caller': '0x%040x' % i,
+        'orderCount': order_count,
+        'fillCount': order_count,
+        'updateCount': order_count,
+    }
+
+def test_failed_batch_only_fails_bad_requests():
+    async def run():
+        # Wait long enough for all three requests to land in one batch.
+        server = PredictionServer(FailingModel(), max_wait=0.5)
+        await server.start()
+        return await asyncio.gather(
+            server.predict([ record(1) ]),
+            server.predict([ record(2, BAD_ORDER_COUNT) ]),
+            server.predict([ record(3) ]),
+            return_exceptions=True,
+        )
+    good1, bad, good2 = asyncio.run(run())
+    assert [ r['caller'] for r in good1 ] == [ '0x%040x' % 1 ]
+    assert [ r['caller'] for r in good2 ] == [ '0x%040x' % 3 ]
+    with pytest.raises(ValueError, match='bad caller'):
+        raise bad
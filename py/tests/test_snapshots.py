@@ -0,0 +1,18 @@
+import pytest
+from snapshots import parse_window_spec
+import time
+
+@pytest.fixture
+def east_of_utc(monkeypatch):
+    # UTC+2, as a POSIX TZ string, so no tz database is needed.
+    monkeypatch.setenv('TZ', 'XYZ-2')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+def test_window_days_are_utc_days(east_of_utc):
+    assert parse_window_spec('snap@2019-08-01..2019-08-03') == ('snap', '2019-08-01', '2019-08-03')
+    assert parse_window_spec('snap@2019-08-01..') == ('snap', '2019-08-01', None)
+    # Timestamps still land in their UTC day.
+    assert parse_window_spec('snap@1564617600..1564703999') == ('snap', '2019-08-01', '2019-08-01')
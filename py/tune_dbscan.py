@@ -0,0 +1,170 @@
+import argparse
+from clustering_model import ClusteringModel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from data_utils import dedup_rows, load_cluster_data
+import itertools
+import json
+import metrics
+import numpy as np
+import os
+import scipy.sparse
+import scipy.sparse.csgraph
+import sklearn.neighbors
+
+TABLE_COLUMNS = (
+    'eps',
+    'min_samples',
+    'cores',
+    'clusters',
+    'outliers',
+    'outlier_rate',
+    'weighted_outlier_rate',
+    'inertia',
+)
+
+# The neighbor graph (and deduplicated data) shared by the grid workers.
+_grid_data = None
+
+def _init_grid_worker(graph, features, weights, counts):
+    global _grid_data
+    _grid_data = (graph, features, weights, counts)
+
+# Build the graph of all pairs of rows within `eps` of each other (including
+# each row and itself), with their distances, `chunk_size` rows at a time.
+# Uses the same neighbor search as `sklearn.cluster.DBSCAN`.
+def build_neighbor_graph(features, eps, chunk_size=4096):
+    neighbors = sklearn.neighbors.NearestNeighbors(radius=eps).fit(features)
+    indptr = [ np.zeros(1, dtype=np.int64) ]
+    indices = []
+    distances = []
+    for i in range(0, len(features), chunk_size):
+        dist, idx = neighbors.radius_neighbors(features[i:i + chunk_size], eps)
+        indptr.append(indptr[-1][-1] + np.cumsum([ len(x) for x in idx ]))
+        indices.extend(idx)
+        distances.extend(dist)
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(distances), np.concatenate(indices), np.concatenate(indptr)),
+        shape=(len(features), len(features)),
+    )
+
+# Evaluate DBSCAN with (`eps`, `min_samples`) on the shared graph, which
+# must have been built with at least `eps`, then fit KMeans with
+# `num_clusters` (one of which is reserved for outliers) on the inliers.
+# Labels are exactly what `sklearn.cluster.DBSCAN` would give, up to which
+# cluster a border point shared by two clusters ends up in.
+def evaluate(eps, min_samples, num_clusters, n_init):
+    graph, features, weights, counts = _grid_data
+    # Distances are stored explicitly, so zero distances (each row and
+    # itself) still count as neighbors.
+    graph = graph.copy()
+    graph.data = (graph.data <= eps).astype(np.float64)
+    graph.eliminate_zeros()
+    is_core = graph @ weights >= min_samples
+    core_graph = graph[is_core][:, is_core]
+    num_dbscan_clusters = 0
+    if core_graph.shape[0]:
+        num_dbscan_clusters, _ = scipy.sparse.csgraph.connected_components(core_graph, directed=False)
+    is_inlier = is_core | (graph @ is_core.astype(np.float64) > 0)
+    inertia = None
+    if np.count_nonzero(is_inlier) >= num_clusters - 1:
+        inertia = float(ClusteringModel.fit_kmeans(
+            features[is_inlier],
+            weights[is_inlier],
+            num_clusters - 1,
+            n_init=n_init,
+        ).inertia_)
+    outliers = int(counts[~is_inlier].sum())
+    return {
+        'eps': eps,
+        'min_samples': min_samples,
+        'cores': int(counts[is_core].sum()),
+        'clusters': num_dbscan_clusters,
+        'outliers': outliers,
+        'outlier_rate': outliers / counts.sum(),
+        'weighted_outlier_rate': float(weights[~is_inlier].sum() / weights.sum()),
+        'inertia': inertia,
+    }
+
+def write_table(file, rows):
+    rows = sorted(rows, key=lambda r: (r['eps'], r['min_samples']))
+    with open(file, 'w', newline='') as f:
+        if os.path.splitext(file)[1].lower() == '.json':
+            json.dump(rows, f, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def print_table(rows):
+    print('%8s %11s %8s %8s %9s %8s %8s %12s' % (
+        'eps', 'min_samples', 'cores', 'clusters', 'outliers', 'rate', 'w. rate', 'inertia',
+    ))
+    for r in sorted(rows, key=lambda r: (r['eps'], r['min_samples'])):
+        print('%8g %11d %8d %8d %9d %7.2f%% %7.2f%% %12s' % (
+            r['eps'],
+            r['min_samples'],
+            r['cores'],
+            r['clusters'],
+            r['outliers'],
+            r['outlier_rate'] * 100,
+            r['weighted_outlier_rate'] * 100,
+            '%.6g' % r['inertia'] if r['inertia'] is not None else '-',
+        ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Grid search the DBSCAN step\'s eps and min_samples')
+    parser.add_argument('-e', '--eps', dest='eps', default='0.05,0.1,0.15,0.2', type=str, help='comma separated eps values to try')
+    parser.add_argument('-s', '--samples', dest='min_samples', default='25,50,100,200', type=str, help='comma separated min_samples values to try')
+    parser.add_argument('-c', '--clusters', dest='num_clusters', default=11, type=int, help='number of final clusters to fit for the inertia')
+    parser.add_argument('--n-init', dest='n_init', default=10, type=int, help='number of KMeans initializations per grid point')
+    parser.add_argument('-j', '--workers', dest='workers', default=os.cpu_count(), type=int, help='number of worker processes')
+    parser.add_argument('-o', '--output', dest='output_file', default=None, type=str, help='write the table to a CSV (or .json) file')
+    parser.add_argument('--no-cache', dest='use_cache', default=True, action='store_false', help='do not read or write the parsed call data cache')
+    metrics.add_arguments(parser)
+    parser.add_argument(dest='call_data_file', type=str, help='the call data file, or a day snapshot window (DIR@SINCE..UNTIL)')
+    args = parser.parse_args()
+    metrics.enable_from_args(args)
+
+    eps_values = sorted(frozenset(float(e) for e in args.eps.split(',')))
+    min_samples_values = sorted(frozenset(int(s) for s in args.min_samples.split(',')))
+
+    call_data = load_cluster_data(args.call_data_file, cache=args.use_cache)
+    print(f'Loaded {len(call_data)} call data entries.')
+
+    # Identical rows are always neighbors, so they're merged (with their
+    # weights summed), which doesn't change any densities.
+    features, weights, inverse = dedup_rows(call_data.features, call_data.weights)
+    counts = np.bincount(inverse, minlength=len(features))
+    print(f'{len(features)} distinct rows.')
+
+    with metrics.span('neighbor_graph'):
+        graph = build_neighbor_graph(features, eps_values[-1])
+    print(f'Built neighbor graph with {graph.nnz} edges at eps = {eps_values[-1]}.')
+
+    rows = []
+    grid = list(itertools.product(eps_values, min_samples_values))
+    with metrics.span('grid'), ProcessPoolExecutor(
+            max_workers=min(args.workers, len(grid)),
+            initializer=_init_grid_worker,
+            initargs=(graph, features, weights, counts),
+        ) as executor:
+        futures = [
+            executor.submit(evaluate, eps, min_samples, args.num_clusters, args.n_init)
+            for (eps, min_samples) in grid
+        ]
+        for future in as_completed(futures):
+            row = future.result()
+            print('eps = %g, min_samples = %d: %d clusters, %.2f%% outliers' % (
+                row['eps'],
+                row['min_samples'],
+                row['clusters'],
+                row['outlier_rate'] * 100,
+            ))
+            rows.append(row)
+
+    print_table(rows)
+    if args.output_file:
+        write_table(args.output_file, rows)
+        print('Wrote grid table to %s.' % args.output_file)
+    metrics.write_from_args(args)
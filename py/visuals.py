@@ -1,4 +1,4 @@
-from data_utils import FEATURES, label_to_classs_name, collapse_clusters
+from data_utils import FEATURES, ClusterSummary, label_to_classs_name
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy
@@ -10,21 +10,13 @@ sns.set()
 def to_feature_name(feature):
     return re.sub(r'^calls_to_(.+)$', r'\1()', feature)
 
-def plot_class_stats(call_data, labels, ordering, ax, scale='log'):
-    unique_labels = tuple(sorted(frozenset(labels)))
-    ordered_labels = [ unique_labels[i] for i in ordering ]
-    fills_by_label = [
-        sum(d['total_fills'] for (d, dl) in zip(call_data, labels) if dl == label)
-        for label in ordered_labels
-    ]
-    orders_by_label = [
-        sum(d['total_orders'] for (d, dl) in zip(call_data, labels) if dl == label)
-        for label in ordered_labels
-    ]
+def plot_class_stats(summary, ordering, ax, scale='log'):
+    fills_by_label = summary.total_fills[ordering]
+    orders_by_label = summary.total_orders[ordering]
     bar_width = 1 / 3
     ax.clear()
     ax.bar(
-        [i - bar_width / 2 for i in range(len(unique_labels))],
+        [i - bar_width / 2 for i in range(len(summary))],
         fills_by_label,
         bar_width,
         align='center',
@@ -32,7 +24,7 @@ def plot_class_stats(call_data, labels, ordering, ax, scale='log'):
         color=(0.882, 0.498, 0.819),
     )
     ax.bar(
-        [i + bar_width / 2 for i in range(len(unique_labels))],
+        [i + bar_width / 2 for i in range(len(summary))],
         orders_by_label,
         bar_width,
         align='center',
@@ -40,18 +32,15 @@ def plot_class_stats(call_data, labels, ordering, ax, scale='log'):
         color=(0.262, 0.839, 0.8),
     )
     ax.set_yscale(scale)
-    ax.set_xticks(np.arange(-0.5, len(unique_labels) + 0.5, 1))
+    ax.set_xticks(np.arange(-0.5, len(summary) + 0.5, 1))
     ax.tick_params(labelbottom=False, bottom=False)
-    ax.set_xlim(-0.5, len(unique_labels) - 1 + 0.5)
+    ax.set_xlim(-0.5, len(summary) - 1 + 0.5)
     ax.legend()
 
-def plot_method_stats(call_data, ordering, ax, scale='log'):
+def plot_method_stats(summary, ordering, ax, scale='log'):
     ordered_features = [ FEATURES[i] for i in reversed(ordering) ]
-    method_counts = [
-        sum(int(d[f] * d['total_calls']) if f in d else 0 for d in call_data)
-            if f.startswith('calls_to_') else 0
-        for f in ordered_features
-    ]
+    method_calls = summary.method_calls.sum(axis=0)
+    method_counts = [ method_calls[i] for i in reversed(ordering) ]
     ax.clear()
     ax.barh(
         list(range(len(ordered_features))),
@@ -68,24 +57,13 @@ def plot_method_stats(call_data, ordering, ax, scale='log'):
     ax.set_ylim(-0.5, len(ordered_features) - 1 + 0.5)
     ax.legend()
 
-def create_label_names(call_data, labels):
-    unique_labels = sorted(frozenset(labels))
+def create_label_names(summary):
     names = []
-    for label in unique_labels:
-        label_calls = [
-            d
-            for (d, cl)
-            in zip(call_data, labels)
-            if cl == label
-        ]
-        num_unique_senders = sum(
-            d['unique_senders']
-            for d in label_calls
-        )
+    for (label, size, num_unique_senders) in zip(summary.labels, summary.sizes, summary.unique_senders):
         name = label_to_classs_name(label)
         if num_unique_senders == 0:
             name = '😊 %s' % name
-        name = '%s (%d)' % (name, len(label_calls))
+        name = '%s (%d)' % (name, size)
         names.append(name)
     return names
 
@@ -109,15 +87,10 @@ def plot_heatmap(
         col_ordering=None,
         row_ordering=None,
     ):
-    features = collapse_clusters(
-        call_data,
-        labels,
-        attenuate=attenuate,
-        brighten=brighten,
-    )
-    unique_labels = sorted(frozenset(labels))
+    summary = ClusterSummary(call_data, labels)
+    features = summary.collapse(attenuate=attenuate, brighten=brighten)
     features = reorder(features, col_ordering, row_ordering)
-    col_names = reorder(create_label_names(call_data, labels), col_ordering)
+    col_names = reorder(create_label_names(summary), col_ordering)
     row_names = reorder([ to_feature_name(s) for s in FEATURES ], row_ordering)
     cg = sns.clustermap(
         np.array(features).transpose(),
@@ -132,20 +105,19 @@ def plot_heatmap(
     )
     if col_ordering is None:
         col_ordering = cg.dendrogram_col.reordered_ind \
-            if cg.dendrogram_col is not None else list(range(len(unique_labels)))
+            if cg.dendrogram_col is not None else list(range(len(summary)))
     if row_ordering is None:
         row_ordering = cg.dendrogram_row.reordered_ind \
             if cg.dendrogram_row is not None else list(range(len(FEATURES)))
     if not draw_dendrogram:
         plot_class_stats(
-            call_data,
-            labels,
+            summary,
             col_ordering,
             cg.ax_col_dendrogram.axes,
             scale='linear' if linear_scale else 'log',
         )
         plot_method_stats(
-            call_data,
+            summary,
             row_ordering,
             cg.ax_row_dendrogram.axes,
             scale='linear' if linear_scale else 'log',